@@ -1,7 +1,11 @@
 from .globals import verbose, info, timeout, db_host, db_port, db_name, db_user, db_pass, \
     admin_emails, SLEEP_PERIOD, consecutive_err_threshold, normalized_tz, max_clients_pool, \
     server_email, server_mail_host, server_mail_port, server_mail_use_ssl, server_email_password, \
-    salt, cipher_key, dev
+    salt, cipher_key, dev, poll_workers, poll_mode, idle_renew_period, \
+    use_mailbox_leases, lease_period, poller_name, max_search_senders, fetch_batch_size, max_mail_size, \
+    imap_pipeline_depth, min_poll_interval, max_poll_interval, poll_backoff_factor, pool_idle_timeout, \
+    connection_fresh_window, retry_base_delay, retry_max_delay, max_retries, smtp_idle_timeout, \
+    outbox_poll_period, admin_digest_window, outbox_max_attempts, outbox_claim_period, parse_cache_size
 
 normalized_tz_obj = None
 
@@ -13,16 +17,39 @@ def load_config():
     global verbose, admin_emails, normalized_tz, normalized_tz_obj, info, timeout, max_clients_pool, \
         db_host, db_port, db_name, db_user, db_pass, SLEEP_PERIOD, consecutive_err_threshold, \
         server_email, server_mail_host, server_mail_port, server_mail_use_ssl, server_email_password, \
-        salt, cipher_key, dev
+        salt, cipher_key, dev, poll_workers, poll_mode, idle_renew_period, \
+        use_mailbox_leases, lease_period, poller_name, max_search_senders, fetch_batch_size, max_mail_size, \
+        imap_pipeline_depth, min_poll_interval, max_poll_interval, poll_backoff_factor, pool_idle_timeout, \
+        connection_fresh_window, retry_base_delay, retry_max_delay, max_retries, smtp_idle_timeout, \
+        outbox_poll_period, admin_digest_window, outbox_max_attempts, outbox_claim_period, parse_cache_size
         
     # Read the config file
     config = ConfigParser.SafeConfigParser(defaults = {
         'max_clients_pool': str(max_clients_pool),
+        'pool_idle_timeout': str(pool_idle_timeout),
+        'connection_fresh_window': str(connection_fresh_window),
+        'retry_base_delay': str(retry_base_delay),
+        'retry_max_delay': str(retry_max_delay),
+        'max_retries': str(max_retries),
+        'poll_workers': str(poll_workers),
+        'max_search_senders': str(max_search_senders),
+        'fetch_batch_size': str(fetch_batch_size),
+        'max_mail_size': str(max_mail_size),
+        'parse_cache_size': str(parse_cache_size),
+        'imap_pipeline_depth': str(imap_pipeline_depth),
+        'use_mailbox_leases': str(use_mailbox_leases),
+        'lease_period': str(lease_period),
+        'poller_name': poller_name,
         'timeout': str(timeout),
         'verbose': str(verbose),
         'info': str(info),
         'normalized_tz': normalized_tz,
         'poll_invertal': str(SLEEP_PERIOD),
+        'poll_mode': poll_mode,
+        'min_poll_interval': '%(poll_invertal)s',
+        'max_poll_interval': str(max_poll_interval),
+        'poll_backoff_factor': str(poll_backoff_factor),
+        'idle_renew_period': str(idle_renew_period),
         'consecutive_err_threshold': str(consecutive_err_threshold),
         'db_username': db_user,
         'db_password': db_pass,
@@ -32,6 +59,11 @@ def load_config():
         'server_mail_host': server_mail_host,
         'server_mail_port': str(server_mail_port),
         'server_mail_use_ssl': str(server_mail_use_ssl),
+        'smtp_idle_timeout': str(smtp_idle_timeout),
+        'outbox_poll_period': str(outbox_poll_period),
+        'admin_digest_window': str(admin_digest_window),
+        'outbox_max_attempts': str(outbox_max_attempts),
+        'outbox_claim_period': str(outbox_claim_period),
         'server_email_password': server_email_password,
         'salt': salt,
         'cipher_key': cipher_key,
@@ -41,12 +73,31 @@ def load_config():
     config.read(os.path.dirname(__file__) + '/settings.ini')
 
     max_clients_pool = config.getint('server', 'max_clients_pool')
+    pool_idle_timeout = config.getint('server', 'pool_idle_timeout')
+    connection_fresh_window = config.getint('server', 'connection_fresh_window')
+    retry_base_delay = config.getint('server', 'retry_base_delay')
+    retry_max_delay = config.getint('server', 'retry_max_delay')
+    max_retries = config.getint('server', 'max_retries')
+    poll_workers = config.getint('server', 'poll_workers')
+    max_search_senders = max(1, config.getint('server', 'max_search_senders'))
+    fetch_batch_size = max(1, config.getint('server', 'fetch_batch_size'))
+    max_mail_size = max(1024, config.getint('server', 'max_mail_size'))
+    parse_cache_size = config.getint('server', 'parse_cache_size')
+    imap_pipeline_depth = max(1, config.getint('server', 'imap_pipeline_depth'))
+    use_mailbox_leases = config.getboolean('server', 'use_mailbox_leases')
+    lease_period = config.getint('server', 'lease_period')
+    poller_name = config.get('server', 'poller_name')
     timeout = config.getint('server', 'timeout')
 
     server_email = config.get('server', 'server_email')
     server_mail_host = config.get('server', 'server_mail_host')
     server_mail_port = config.getint('server', 'server_mail_port')
     server_mail_use_ssl = config.getboolean('server', 'server_mail_use_ssl')
+    smtp_idle_timeout = config.getint('server', 'smtp_idle_timeout')
+    outbox_poll_period = config.getint('server', 'outbox_poll_period')
+    admin_digest_window = config.getint('server', 'admin_digest_window')
+    outbox_max_attempts = config.getint('server', 'outbox_max_attempts')
+    outbox_claim_period = config.getint('server', 'outbox_claim_period')
     server_email_password = config.get('server', 'server_email_password')
 
     db_host = config.get('db', 'db_host')
@@ -65,6 +116,13 @@ def load_config():
     verbose = config.getboolean('app', 'verbose')
     info = config.getboolean('app', 'info') or verbose
     SLEEP_PERIOD = config.getint('app', 'poll_invertal')
+    min_poll_interval = config.getint('app', 'min_poll_interval')
+    max_poll_interval = config.getint('app', 'max_poll_interval')
+    poll_backoff_factor = config.getfloat('app', 'poll_backoff_factor')
+    poll_mode = config.get('app', 'poll_mode').strip().lower()
+    if poll_mode not in ('poll', 'idle'):
+        raise ValueError("poll_mode must be 'poll' or 'idle'. Got '%s'." % poll_mode)
+    idle_renew_period = config.getint('app', 'idle_renew_period')
     consecutive_err_threshold = config.getint('app', 'consecutive_err_threshold')
     salt = config.get('app', 'salt')
     cipher_key = config.get('app', 'cipher_key')
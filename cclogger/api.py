@@ -65,7 +65,7 @@ def update_email_password(email, new_password, **kwargs):
     usermail = UserMail.get(UserMail.email == email)
     usermail.password = new_password
     usermail.is_bad = False
-    usermail.save()
+    usermail.save(only=[UserMail.password, UserMail.is_bad]) # The pollers own the lease and uid mark fields.
     
     return {'EncryptedPassword': new_password}
 
@@ -116,7 +116,7 @@ def add_account(token, email, password, **kwargs):
         usermail.is_dummy = False
         usermail.password = password
         usermail.is_bad = False
-        usermail.save()
+        usermail.save(only=[UserMail.is_dummy, UserMail.password, UserMail.is_bad])
     else:
         userid = data['userid']
 
@@ -146,7 +146,10 @@ def add_account(token, email, password, **kwargs):
             password = encrypt(password, True)
             usermail.password = password
             usermail.is_dummy = False
-            usermail.save()
+            if create_usermailmap:
+                usermail.save()
+            else:
+                usermail.save(only=[UserMail.is_dummy, UserMail.password, UserMail.is_bad])
 
             if create_usermailmap:
                 UserMailMap.create(user=user, user_mail=usermail)
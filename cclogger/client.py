@@ -1,20 +1,26 @@
+import cgi
 import imaplib
 import os
-import string
 import email
 import email.utils
-import smtplib
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 import re
 import time
-
+import threading
+from collections import OrderedDict
+
+from .smtp_pool import SmtpConnectionPool
+from .mime import MimeEntity, find_body_entities
+from .html_text import html_to_text, normalize_text
+from .compress import enable_deflate
+from .pipeline import ImapPipeline
 from .common_util import rfc822date_to_datetime, rfc822date_to_tzinfo, Bunch, decrypt
-from . import verbose, info, timeout, max_clients_pool, server_email, server_mail_host, server_mail_port, \
-    server_mail_use_ssl, server_email_password
+from . import verbose, info, timeout, max_clients_pool, pool_idle_timeout, connection_fresh_window, max_search_senders, \
+    fetch_batch_size, server_email, server_mail_host, server_mail_port, server_mail_use_ssl, server_email_password, \
+    smtp_idle_timeout, max_mail_size, imap_pipeline_depth
 
-HTML_TAGS_RE = re.compile(r"</?[^<>]+>")
-HTML_NEWLINE_RE = re.compile(r"<\s*br\s*/?>|<\s*tr\s*/?>", flags=re.IGNORECASE)
+smtp_pool = SmtpConnectionPool(smtp_idle_timeout)
 
 if False: # Use proxy quick hack.
     import socks
@@ -22,64 +28,194 @@ if False: # Use proxy quick hack.
     socks.setdefaultproxy(socks.PROXY_TYPE_SOCKS4, '148.87.19.20', 80, True)
     socket.socket = socks.socksocket
 
+class RetryLater(Exception):
+    """Raised instead of sleeping and retrying in place, by clients with defer_retries set.
+    The caller is expected to retry the whole operation later."""
+    def __init__(self, cause):
+        super(RetryLater, self).__init__(str(cause))
+        self.cause = cause
+
 def retryableCall(f, retries, delay, client):
     while True:
         try:
-            return f()
-        except imaplib.IMAP4_SSL.abort, imaplib.IMAP4.abort:
-            if retries > 0:
+            res = f()
+            client.last_activity = time.time()
+            return res
+        except (imaplib.IMAP4_SSL.abort, imaplib.IMAP4.abort), e:
+            if retries > 0 or client.defer_retries:
                 retries -= 1
                 try:
                     client.mail.shutdown()
-                except Exception, e:
+                except Exception, e2:
                     if verbose:
-                        print 'Error in shutting down mail.', e
-                        print e
+                        print 'Error in shutting down mail.', e2
+                        print e2
+                client.mail = None # Else open_connection may trust it as recently used.
+                if client.defer_retries:
+                    raise RetryLater(e)
 
                 time.sleep(delay)
                 client.open_connection(non_retryable=True)
             else:
                 raise
-        except imaplib.IMAP4_SSL.readonly, imaplib.IMAP4.readonly:
+        except (imaplib.IMAP4_SSL.readonly, imaplib.IMAP4.readonly), e:
+            if client.defer_retries:
+                raise RetryLater(e)
             if retries > 0:
                 retries -= 1
                 time.sleep(delay)
             else:
                 raise
 
+FETCH_MSG_START_RE = re.compile(r"^\d+\s+\(")
+FETCH_UID_RE = re.compile(r"\bUID\s+(\d+)", flags=re.IGNORECASE)
+FETCH_LITERAL_RE = re.compile(r"([A-Z0-9.]+(\[[^\]]*\])?(<\d+>)?)\s*\{\d+\}$", flags=re.IGNORECASE)
+
+def parse_fetch_response(data):
+    """Splits the data imaplib returns for a multi-message FETCH into messages.
+
+    A message arrives as (prefix, literal) tuples, one per literal item, and plain strings for
+    the rest, e.g. [('1 (UID 5 BODY[] {342}', '...'), ')']. Returns a list of
+    (uid, non-literal text, {item name: literal}). Messages without a UID (e.g. unsolicited
+    flag updates) are left out.
+    """
+    msgs = []
+    cur = None
+    for item in data:
+        text = item[0] if isinstance(item, tuple) else item
+        if text is None:
+            continue
+        if cur is None or FETCH_MSG_START_RE.match(text):
+            cur = ['', dict()]
+            msgs.append(cur)
+        if isinstance(item, tuple):
+            m = FETCH_LITERAL_RE.search(text)
+            if m:
+                cur[1][m.group(1).upper()] = item[1]
+                text = text[:m.start()]
+        cur[0] += text
+
+    out = []
+    for text, literals in msgs:
+        m = FETCH_UID_RE.search(text)
+        if m:
+            out.append((m.group(1), text, literals))
+    return out
+
+def compact_uid_set(uids):
+    """Makes an IMAP sequence set of uids with consecutive runs as ranges. e.g. 1,2,3,7 => 1:3,7"""
+    uids = sorted(set(long(uid) for uid in uids))
+    ranges = []
+    for uid in uids:
+        if ranges and ranges[-1][1] == uid - 1:
+            ranges[-1][1] = uid
+        else:
+            ranges.append([uid, uid])
+    return ','.join(str(a) if a == b else '%d:%d' % (a, b) for a, b in ranges)
+
+def or_search_keys(keys):
+    """Combines IMAP SEARCH keys using OR, which takes exactly two keys. The nesting is kept balanced."""
+    if len(keys) == 1:
+        return keys[0]
+    mid = len(keys) / 2
+    return 'OR %s %s' % (or_search_keys(keys[:mid]), or_search_keys(keys[mid:]))
+
 class MailClientManager(object):
+    """Bounded pool of logged in mail clients shared by the poller workers.
+
+    Clients not in use are kept in LRU order. When more than max_clients_pool are idle the least
+    recently used ones are closed, as are the ones idle for more than pool_idle_timeout secs.
+    So however many mail boxes there are, the busiest ones keep warm connections.
+    """
+
     def __init__(self):
-        self.client_map = dict()
-        self.count = 0
-        self.is_cache_disabled = False
+        self.idle_clients = OrderedDict() # email -> (client, encrypted password, time returned). LRU first.
+        self.checked_out = dict() # email -> (client, encrypted password)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
 
     def get_mail_client_from_pool(self, for_usermail):
-        if self.is_cache_disabled:
-            client = MailClient(for_usermail.in_mail_config, for_usermail.out_mail_config,
-                for_usermail.email, decrypt(for_usermail.password, True))
-        else:
-            client = self.client_map.get(for_usermail.email, None)
-            if not client:
+        to_close = []
+        with self.lock:
+            to_close.extend(self._expire_idle())
+            client, password, _ = self.idle_clients.pop(for_usermail.email, (None, None, None))
+            if client and password != for_usermail.password:
+                to_close.append(client) # Password got changed.
+                client = None
+            if client:
+                self.hits += 1
+            else:
+                self.misses += 1
                 client = MailClient(for_usermail.in_mail_config, for_usermail.out_mail_config,
                     for_usermail.email, decrypt(for_usermail.password, True))
-                self.count += 1
-                if self.count > max_clients_pool:
-                    self.is_cache_disabled = True # If number of mails to access is more than limit then
-                                                  # there is no point in caching now. Snce, all mails will
-                                                  # always be accessed one by one, in each run.
-                    for email in self.client_map.keys():
-                        self.client_map[email].close_connection()
-                        del self.client_map[email]
-                else:
-                    self.client_map[for_usermail.email] = client
-
-        client.open_connection()
+                client.defer_retries = True # A poller worker must not sleep while other mail boxes wait.
+            self.checked_out[for_usermail.email] = (client, for_usermail.password)
+
+        self._close_all(to_close)
+
+        try:
+            client.open_connection()
+        except:
+            self.return_client_to_pool(client)
+            raise
         return client
 
     def return_client_to_pool(self, client):
-        if self.is_cache_disabled:
+        to_close = []
+        with self.lock:
+            checked_out, password = self.checked_out.get(client.username, (None, None))
+            if checked_out is not client:
+                to_close.append(client) # Not from this pool.
+            else:
+                del self.checked_out[client.username]
+                if client.mail is not None:
+                    old = self.idle_clients.pop(client.username, None)
+                    if old:
+                        to_close.append(old[0])
+                    self.idle_clients[client.username] = (client, password, time.time())
+            while len(self.idle_clients) > max_clients_pool:
+                to_close.append(self.idle_clients.popitem(last=False)[1][0])
+                self.evictions += 1
+        self._close_all(to_close)
+
+    def _expire_idle(self):
+        """Removes and returns the clients idle for too long. Must be called with the lock held."""
+        expired = []
+        deadline = time.time() - pool_idle_timeout
+        while self.idle_clients:
+            email, (client, _, returned_at) = next(self.idle_clients.iteritems())
+            if returned_at > deadline:
+                break # Rest are more recent.
+            del self.idle_clients[email]
+            expired.append(client)
+            self.evictions += 1
+        return expired
+
+    def _close_all(self, clients):
+        for client in clients: # Closing is slow, so done outside the lock.
             client.close_connection()
 
+    def close_idle(self):
+        """Logs out all the idle clients, e.g. on shutdown."""
+        with self.lock:
+            clients = [client for client, _, _ in self.idle_clients.values()]
+            self.idle_clients.clear()
+        self._close_all(clients)
+
+    def get_stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': float(self.hits) / total if total else 0.0,
+                'evictions': self.evictions,
+                'idle': len(self.idle_clients),
+                'in_use': len(self.checked_out)
+            }
+
 class MailClient(object):
     def __init__(self, in_mail_config, out_mail_config, username=None, password=None, mail=None):
         self.mail = mail
@@ -87,6 +223,12 @@ class MailClient(object):
         self.password = password
         self.in_mail_config = in_mail_config
         self.out_mail_config = out_mail_config
+        self.uid_validity = None
+        self.uid_next = None
+        self.capabilities = None
+        self.last_activity = 0 # When a command last succeeded on this connection.
+        self.defer_retries = False # If True, failed commands raise RetryLater instead of blocking to retry.
+        self.use_compress = getattr(in_mail_config, 'use_compress', False)
 
     def open_connection(self, username=None, password=None, retries=5, delay=3, non_retryable=False):
         if username is not None:
@@ -95,9 +237,15 @@ class MailClient(object):
             self.password = password
 
         if self.mail:
+            if time.time() - self.last_activity < connection_fresh_window:
+                # Used moments ago, so most likely still open. If not, the next command aborts and
+                # retryableCall reconnects.
+                if verbose: print 'Connection was used recently. Not checking it.'
+                return True
             try:
                 if verbose: print 'mail is not None. Checking if it is already open.'
                 self.mail.noop()
+                self.last_activity = time.time()
                 if verbose: print 'Connection is still open.'
                 return True
             except Exception, e:
@@ -121,11 +269,36 @@ class MailClient(object):
 
         if non_retryable:
             mail.login(self.username, self.password)
-            mail.select("inbox")
+            self.select_inbox(mail)
         else:
             retryableCall(lambda : mail.login(self.username, self.password), retries, delay, self)
-            retryableCall(lambda : mail.select("inbox"), retries, delay, self) # connect to inbox.
+            retryableCall(lambda : self.select_inbox(mail), retries, delay, self) # connect to inbox.
         self.mail = mail
+        self.capabilities = None
+        self.last_activity = time.time()
+        if self.use_compress and self.has_capability('COMPRESS=DEFLATE'):
+            enable_deflate(mail)
+
+    def has_capability(self, name):
+        """Checks the capabilities the server advertises after login. They are fetched once per connection."""
+        if self.capabilities is None:
+            result, data = retryableCall(lambda : self.mail.capability(), 5, 3, self)
+            if result == 'OK':
+                self.capabilities = tuple(data[0].upper().split())
+            else:
+                self.capabilities = tuple(self.mail.capabilities) # The pre-login ones.
+        return name.upper() in self.capabilities
+
+    def select_inbox(self, mail):
+        result, data = mail.select("inbox")
+        if result == 'OK':
+            try:
+                self.uid_validity = long(mail.response('UIDVALIDITY')[1][0])
+                self.uid_next = long(mail.response('UIDNEXT')[1][0])
+            except (TypeError, ValueError, IndexError):
+                self.uid_validity = None # Server did not send them. Every poll will be a full resync.
+                self.uid_next = None
+        return result, data
 
     def close_connection(self):
         if self.mail:
@@ -142,40 +315,58 @@ class MailClient(object):
             return
         if verbose: print 'Connection was not open. Cannot close it.'
 
-    def get_new_mail_uids(self, retries=5, delay=3):
+    def get_new_mail_uids(self, since_uid=None, from_emails=None, retries=5, delay=3):
+        """Returns uids of unseen mails, or if since_uid is given then of all the mails with uid >= since_uid.
+        If from_emails is given then only the mails from those addresses are searched for."""
         if verbose: print 'Getting list of new mails.'
 
-        result, data = retryableCall(lambda : self.mail.uid('search', None, "UNSEEN"), retries, delay, self) # search and return uids instead
-        
-        if verbose: print (result, data)
-        if result == 'OK':
-            return data[0].split()
-
-        raise Exception("get_new_mail_uids failed. Got bad result %s" % result)
-
-    # note that if you want to get html content (body) and the email contains
-    # multiple payloads (plaintext / html), you must parse each message separately.
-    # use something like the following: (taken from a stackoverflow post)
-    def get_html_block(self, email_message_instance):
-        text_body = None
-        maintype = email_message_instance.get_content_maintype()
-        if maintype == 'multipart':
-            for part in email_message_instance.get_payload():
-                if part.get_content_maintype() == 'html':
-                    return part.get_payload()
-                elif part.get_content_maintype() == 'text':
-                    text_body = part.get_payload()
-        elif maintype == 'html':
-            return email_message_instance.get_payload()
-        elif maintype == 'text':
-            text_body = email_message_instance.get_payload()
-
-        if text_body:
-            return '<html><head></head><body><pre>%s</pre></body></html>' % text_body
+        if since_uid:
+            criteria = "UID %d:*" % since_uid
+        else:
+            criteria = "UNSEEN"
 
-    def parse_email(self, raw_mail):
+        if from_emails is None:
+            batches = [criteria]
+        else:
+            # Long OR chains are slow or rejected by some servers. So the senders are split into many searches.
+            batches = ['%s %s' % (criteria, or_search_keys(['FROM "%s"' % e for e in from_emails[i:i + max_search_senders]]))
+                for i in range(0, len(from_emails), max_search_senders)]
+
+        uids = set()
+        # Parenthesized, else imaplib quotes the whole criteria as one string.
+        results = retryableCall(lambda : list(self.pipeline().uid('search', [(None, '(%s)' % batch) for batch in batches])),
+            retries, delay, self) # search and return uids instead
+        for result, data in results:
+            if verbose: print (result, data)
+            if result != 'OK':
+                raise Exception("get_new_mail_uids failed. Got bad result %s" % result)
+            for line in data:
+                uids.update((line or '').split())
+
+        uids = list(uids)
+        if since_uid:
+            # n:* always matches the last mail, even when its uid is less than n.
+            uids = [uid for uid in uids if long(uid) >= since_uid]
+        return uids
+
+    def get_body_views(self, message):
+        """Returns (html, text) of the mail, both unicode. When the mail has only one of them the other
+        is made from it. message is a MimeEntity, so only the parts holding these are loaded. The text
+        is normalised by html_text.normalize_text."""
+        html_entity, text_entity = find_body_entities(message)
+        html = html_entity.get_decoded_body() if html_entity else None
+        text = text_entity.get_decoded_body() if text_entity else None
+        if html is None and text is not None:
+            html = u'<html><head></head><body><pre>%s</pre></body></html>' % cgi.escape(text)
+        elif text is None and html is not None:
+            text = html_to_text(html)
+        if text is not None:
+            text = normalize_text(text)
+        return html, text
 
-        email_message = email.message_from_string(raw_mail)
+    def parse_email(self, raw_mail):
+        message = MimeEntity(raw_mail)
+        email_message = message.headers
         complexTos = []
         if not email_message['To'] is None:
             complexTos.extend(email_message['To'].split(','))
@@ -194,29 +385,73 @@ class MailClient(object):
             'From': fromMail,
             'Subject': email_message['Subject'],
             'Date': rfc822date_to_datetime(email_message['Date']),
-            'DateTzinfo': rfc822date_to_tzinfo(email_message['Date']),
-            'Body': self.get_html_block(email_message)
+            'DateTzinfo': rfc822date_to_tzinfo(email_message['Date'])
         }
+        mail['Body'], mail['Text'] = self.get_body_views(message)
 
         if verbose:
             print 'parsed email', 'TO: ', mail['To'], 'From: ', mail['From'], 'Subject: ', mail['Subject']
         return mail
 
     def fetch_mail(self, uid, retries=5, delay=3):
-
-        if verbose: print 'Fetching full mail for uid %s' % uid
-        #result, data = mail.uid('fetch', uid, '(RFC822)')
-        result, data = retryableCall(lambda : self.mail.uid('fetch', uid, '(BODY.PEEK[HEADER])'), retries, delay, self)
-        if result == 'OK':
-            header = data[0][1]
-            result, data = retryableCall(lambda : self.mail.uid('fetch', uid, '(BODY.PEEK[TEXT])'), retries, delay, self)
-            if result == 'OK':
-                body = data[0][1]
-                if verbose:
-                    print 'Raw mail dump:-'
-                    print (result, data)
-                return self.parse_email("%s\n%s" % (header, body))
-        raise Exception("fetch_mail failed. Got bad result %s" % result)
+        for _, mail in self.fetch_mails([uid], retries, delay):
+            if mail is None:
+                raise Exception("fetch_mail failed. No mail with uid %s" % uid)
+            return mail
+
+    def pipeline(self):
+        return ImapPipeline(self.mail, imap_pipeline_depth)
+
+    def uid_fetch_batches(self, uids, items, retries=5, delay=3):
+        """Generator of (uids, {uid: (non-literal text, {item name: literal})}) for windows of up to
+        imap_pipeline_depth batches. Each batch of fetch_batch_size uids is fetched by one UID FETCH, and
+        the batches of a window are pipelined.
+
+        The responses of a window are merged and keyed by the UID each FETCH response carries, since the
+        server need not send them before the tagged response of their own batch. A whole window is held
+        in memory, so a poller worker holds up to imap_pipeline_depth * fetch_batch_size * max_mail_size
+        bytes of fetched mail."""
+        batches = [uids[i:i + fetch_batch_size] for i in range(0, len(uids), fetch_batch_size)]
+        # Done a window at a time, so that a retry after a dropped connection only repeats that window.
+        for i in range(0, len(batches), imap_pipeline_depth):
+            window = batches[i:i + imap_pipeline_depth]
+            if verbose: print 'Fetching %s for uids %s' % (items, ' '.join(','.join(b) for b in window))
+            results = retryableCall(lambda : list(self.pipeline().uid('fetch', [(','.join(b), items) for b in window])),
+                retries, delay, self)
+            fetched = dict()
+            for result, data in results:
+                if result != 'OK':
+                    raise Exception("UID FETCH %s failed. Got bad result %s" % (items, result))
+                for uid, text, literals in parse_fetch_response(data):
+                    # A mail can get more than one response, e.g. a flag update besides the fetched items.
+                    prev_text, prev_literals = fetched.get(uid, ('', dict()))
+                    prev_literals.update(literals)
+                    fetched[uid] = (prev_text + text, prev_literals)
+            yield [uid for batch in window for uid in batch], fetched
+
+    def fetch_envelopes(self, uids, retries=5, delay=3):
+        """Generator of (uid, from email, subject) fetching only those two headers, batched like fetch_mails."""
+        for window, fetched in self.uid_fetch_batches(uids, '(UID BODY.PEEK[HEADER.FIELDS (FROM SUBJECT)])', retries, delay):
+            for uid in window:
+                headers = fetched.get(uid, ('', dict()))[1].get('BODY[HEADER.FIELDS (FROM SUBJECT)]', None)
+                if headers is None:
+                    continue
+                headers = email.message_from_string(headers)
+                yield uid, email.utils.parseaddr(headers['From'] or '')[1].strip().lower(), headers['Subject']
+
+    def fetch_mails(self, uids, retries=5, delay=3):
+        """Generator of (uid, parsed mail) in the order of uids. Each batch of fetch_batch_size uids is
+        fetched by a single UID FETCH. Mail is None for uids which no longer exist."""
+        # Only the first max_mail_size bytes are fetched. The alert text comes before any attachments.
+        items = '(UID BODY.PEEK[]<0.%d>)' % max_mail_size
+        for window, fetched in self.uid_fetch_batches(uids, items, retries, delay):
+            if verbose:
+                print 'Raw mail dump:-'
+                print fetched
+
+            for uid in window:
+                raw_mail = fetched.pop(uid, ('', dict()))[1].get('BODY[]<0>', None)
+                yield uid, (self.parse_email(raw_mail) if raw_mail is not None else None)
 
     def mark_mail_as_read(self, uid, retries=5, delay=3):
         if verbose: print 'Marking mail with uid %s as seen.' % uid
@@ -226,6 +461,24 @@ class MailClient(object):
         if verbose: print 'mark_mail_as_read: result, data', result, data
         return result == 'OK'
 
+    def mark_mails_as_read(self, uids, retries=5, delay=3):
+        """Flags all of uids as seen using one UID STORE. Returns the uids which could not be flagged."""
+        if not uids:
+            return []
+        uid_set = compact_uid_set(uids)
+        if verbose: print 'Marking mails with uids %s as seen.' % uid_set
+
+        result, data = retryableCall(lambda : self.mail.uid('store', uid_set, '+FLAGS.SILENT', r'(\Seen)'), retries, delay, self)
+
+        if verbose: print 'mark_mails_as_read: result, data', result, data
+        if result == 'OK':
+            return []
+        # Some uid in the set made the server refuse. Find out which, so that the rest still get flagged.
+        if verbose: print 'Marking mails with uids %s as seen one by one.' % uid_set
+        results = retryableCall(lambda : list(self.pipeline().uid('store', [(uid, '+FLAGS', r'(\Seen)') for uid in uids])),
+            retries, delay, self)
+        return [uid for uid, (result, data) in zip(uids, results) if result != 'OK']
+
     def send_mail(self, to, from_email, subject, html_body):
         if not self.out_mail_config:
             raise Exception('out_mail_config not set. Cannot send mail.')
@@ -249,7 +502,7 @@ def send_mail(to, from_email, subject, html_body, out_mail_config, username, pas
     msg['To'] = ', '.join(map(str,tonew))
     #msg['To'] = 'app<admin@gmail.com>, '
     
-    part1 = MIMEText(html_to_text(html_body), 'plain')
+    part1 = MIMEText(html_to_text(html_body).encode('utf-8'), 'plain', 'utf-8')
     part2 = MIMEText(html_body, 'html')
     # Attach parts into message container.
     # According to RFC 2046, the last part of a multipart message, in this case
@@ -262,20 +515,7 @@ def send_mail(to, from_email, subject, html_body, out_mail_config, username, pas
     if verbose:
         print 'Sending mail', out_mail_config.hostname, out_mail_config.port, timeout, out_mail_config.use_ssl , tonew, subject
 
-    if out_mail_config.use_ssl:
-        s = smtplib.SMTP_SSL(out_mail_config.hostname, out_mail_config.port, timeout=timeout)
-    else:
-        s = smtplib.SMTP(out_mail_config.hostname, out_mail_config.port, timeout=timeout)
-    s.login(username, password)
-    s.sendmail(from_email, tonew, msg.as_string())
-    s.quit()
-
-def html_to_text(html):
-    text = html
-    text = string.replace(text, "\n", "")
-    text = HTML_NEWLINE_RE.sub("\n", text)
-    text = HTML_TAGS_RE.sub("", text)
-    return text
+    smtp_pool.sendmail(out_mail_config, username, password, from_email, tonew, msg.as_string())
 
 def server_send_mail(to, subject, html_body):
     conf = Bunch()
@@ -0,0 +1,105 @@
+import imaplib
+import threading
+import zlib
+
+from . import verbose, info
+
+imaplib.Commands.setdefault('COMPRESS', ('AUTH', 'SELECTED'))
+
+class DeflateStream(object):
+    """IMAP COMPRESS=DEFLATE (RFC 4978). Raw deflate both ways, each sent command flushed with
+    Z_SYNC_FLUSH so that the server can act on it right away."""
+
+    def __init__(self, recv, sendall):
+        self.recv = recv
+        self.sendall = sendall
+        self.compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+        self.decompressor = zlib.decompressobj(-15)
+        self.buf = ''
+
+    def _fill(self):
+        data = self.recv(16384)
+        if not data:
+            raise imaplib.IMAP4.abort('socket error: EOF')
+        compression_stats.add_in(len(data))
+        self.buf += self.decompressor.decompress(data)
+
+    def read(self, size):
+        chunks = []
+        while size > 0:
+            if not self.buf:
+                self._fill()
+            chunk, self.buf = self.buf[:size], self.buf[size:]
+            chunks.append(chunk)
+            size -= len(chunk)
+        data = ''.join(chunks)
+        compression_stats.add_in(0, len(data))
+        return data
+
+    def readline(self):
+        while '\n' not in self.buf:
+            self._fill()
+        line, self.buf = self.buf.split('\n', 1)
+        compression_stats.add_in(0, len(line) + 1)
+        return line + '\n'
+
+    def send(self, data):
+        out = self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        compression_stats.add_out(len(out), len(data))
+        self.sendall(out)
+
+class CompressionStats(object):
+    """Bytes on the wire against bytes before compression, over all compressed connections."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.wire_in = self.plain_in = self.wire_out = self.plain_out = 0
+
+    def add_in(self, wire, plain=0):
+        with self.lock:
+            self.wire_in += wire
+            self.plain_in += plain
+
+    def add_out(self, wire, plain):
+        with self.lock:
+            self.wire_out += wire
+            self.plain_out += plain
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                'wire_in': self.wire_in,
+                'plain_in': self.plain_in,
+                'ratio_in': float(self.wire_in) / self.plain_in if self.plain_in else 1.0,
+                'wire_out': self.wire_out,
+                'plain_out': self.plain_out
+            }
+
+compression_stats = CompressionStats()
+
+def enable_deflate(mail):
+    """Sends COMPRESS DEFLATE and on success routes mail's reads and writes through a DeflateStream.
+    Must be called when no response is pending, since bytes imaplib has buffered are not seen by it.
+    Returns False if the server refused, and the connection goes on uncompressed."""
+    try:
+        typ, data = mail._simple_command('COMPRESS', 'DEFLATE')
+    except mail.abort:
+        raise # Connection is gone. Not a refusal.
+    except mail.error, e:
+        if info: print 'COMPRESS DEFLATE failed. Going on uncompressed.', e
+        return False
+    if typ != 'OK':
+        if verbose: print 'Server refused COMPRESS DEFLATE:', data
+        return False
+
+    sslobj = getattr(mail, 'sslobj', None)
+    if sslobj:
+        stream = DeflateStream(sslobj.read, sslobj.sendall)
+    else:
+        stream = DeflateStream(mail.sock.recv, mail.sock.sendall)
+    mail.read = stream.read
+    mail.readline = stream.readline
+    mail.send = stream.send
+    mail.deflate = stream
+    if verbose: print 'COMPRESS DEFLATE is active.'
+    return True
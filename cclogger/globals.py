@@ -14,14 +14,39 @@ db_host = 'localhost'
 db_port = 0 # Signifies no port is provided
 
 SLEEP_PERIOD = 5 #in sec
+min_poll_interval = SLEEP_PERIOD # Secs. A mailbox is polled at least this far apart...
+max_poll_interval = 600 # ...and at most this far apart.
+poll_backoff_factor = 1.5 # Poll interval is multiplied by this when a poll finds nothing and divided when it finds mails.
+poll_mode = 'poll' # 'poll' or 'idle'. In idle mode mailboxes whose server supports IDLE are not polled.
+idle_renew_period = 1500 # Secs after which IDLE is restarted. Servers drop it after 30 mins.
 consecutive_err_threshold = 10
 max_clients_pool = 10
+pool_idle_timeout = 300 # Secs after which an unused pooled mail connection is closed.
+connection_fresh_window = 60 # Secs. Mail connections used within this are not checked with NOOP before reuse.
+retry_base_delay = 3 # Secs. A poll that lost its connection is retried after this, doubling on every retry...
+retry_max_delay = 60 # ...up to this.
+max_retries = 5
+max_search_senders = 20 # Max FROM keys ORed in one IMAP SEARCH.
+fetch_batch_size = 50 # Max mails downloaded by one IMAP FETCH.
+imap_pipeline_depth = 4 # Max IMAP commands sent before waiting for their responses.
+# A poller worker holds up to imap_pipeline_depth * fetch_batch_size * max_mail_size bytes of fetched mail.
+max_mail_size = 1048576 # Bytes. Only this much of a mail is downloaded and parsed.
+parse_cache_size = 10000 # Parse outcomes remembered, so that repeats of an alert skip the parsers. 0 disables.
+poll_workers = 8 # Number of mailboxes polled in parallel.
+use_mailbox_leases = False # True when many poller instances share the mailboxes.
+lease_period = 60 # Secs. Must be more than the time taken by a poll cycle.
+poller_name = '' # Unique name of this poller instance. Defaults to hostname:pid.
 
 server_email = ''
 server_email_password = ''
 server_mail_host = ''
 server_mail_port = 0
 server_mail_use_ssl = True
+smtp_idle_timeout = 60 # Secs after which an unused pooled SMTP session is closed.
+outbox_poll_period = 5 # Secs between checks for queued mails to send.
+admin_digest_window = 60 # Secs. Admin alerts raised within this are sent together as one mail.
+outbox_max_attempts = 5 # A queued mail is dropped after failing to send this many times.
+outbox_claim_period = 300 # Secs a sender may take to send the mails it claimed, before others may take them over.
 
 salt = '-'
 cipher_key = None
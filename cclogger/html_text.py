@@ -0,0 +1,90 @@
+import HTMLParser
+import htmlentitydefs
+import re
+
+# Tags whose start or end begins a new line of text.
+BLOCK_TAGS = frozenset(['address', 'blockquote', 'br', 'center', 'dd', 'div', 'dl', 'dt', 'form', 'h1', 'h2',
+    'h3', 'h4', 'h5', 'h6', 'hr', 'li', 'ol', 'p', 'pre', 'table', 'tbody', 'thead', 'title', 'tr', 'ul'])
+# Tags separated from their neighbours by a space, so that the cells of a row read as one line.
+CELL_TAGS = frozenset(['td', 'th'])
+# Tags whose content is not text.
+SKIP_TAGS = frozenset(['script', 'style'])
+
+HTML_TAGS_RE = re.compile(r"</?[^<>]+>")
+SPACES_RE = re.compile(r"[ \t\r\f\v\xa0]+", re.UNICODE)
+BLANK_LINES_RE = re.compile(r"\s*\n\s*")
+
+def normalize_text(text):
+    "Collapses runs of spaces, trims the lines and drops blank ones. Keeps a trailing newline."
+    text = SPACES_RE.sub(u' ', text)
+    text = BLANK_LINES_RE.sub(u'\n', text).strip()
+    return text + u'\n' if text else text
+
+class TextExtractor(HTMLParser.HTMLParser):
+    """Collects the text of html as it is fed, with entities resolved and block elements on lines of their own.
+    No tree is built, so the cost is one pass over the markup."""
+
+    def __init__(self):
+        HTMLParser.HTMLParser.__init__(self)
+        self.chunks = list()
+        self.skip_depth = 0
+        self.pre_depth = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'pre':
+            self.pre_depth += 1
+        if tag in SKIP_TAGS:
+            self.skip_depth += 1
+        elif tag in BLOCK_TAGS:
+            self.chunks.append(u'\n')
+        elif tag in CELL_TAGS:
+            self.chunks.append(u' ')
+
+    def handle_startendtag(self, tag, attrs):
+        if tag in BLOCK_TAGS:
+            self.chunks.append(u'\n')
+
+    def handle_endtag(self, tag):
+        if tag == 'pre':
+            self.pre_depth = max(0, self.pre_depth - 1)
+        if tag in SKIP_TAGS:
+            self.skip_depth = max(0, self.skip_depth - 1)
+        elif tag in BLOCK_TAGS:
+            self.chunks.append(u'\n')
+        elif tag in CELL_TAGS:
+            self.chunks.append(u' ')
+
+    def handle_data(self, data):
+        if not self.skip_depth:
+            # Newlines in the markup are not line breaks of the text, except in pre.
+            self.chunks.append(data if self.pre_depth else data.replace('\n', ' '))
+
+    def handle_entityref(self, name):
+        if not self.skip_depth:
+            codepoint = htmlentitydefs.name2codepoint.get(name, None)
+            self.chunks.append(unichr(codepoint) if codepoint else u'&%s;' % name)
+
+    def handle_charref(self, name):
+        if not self.skip_depth:
+            try:
+                codepoint = int(name[1:], 16) if name[:1] in ('x', 'X') else int(name)
+                self.chunks.append(unichr(codepoint))
+            except (ValueError, OverflowError):
+                self.chunks.append(u'&#%s;' % name)
+
+    def get_text(self):
+        return u''.join(self.chunks)
+
+def html_to_text(html):
+    """Returns the normalised plain text of html as unicode. str is taken to be utf-8."""
+    if isinstance(html, str):
+        html = html.decode('utf-8', 'replace')
+    extractor = TextExtractor()
+    try:
+        extractor.feed(html)
+        extractor.close()
+        text = extractor.get_text()
+    except HTMLParser.HTMLParseError:
+        # Markup too broken for HTMLParser. Dropping the tags still leaves the text to match.
+        text = HTML_TAGS_RE.sub(u' ', html)
+    return normalize_text(text)
@@ -0,0 +1,287 @@
+import errno
+import re
+import select
+import threading
+import time
+import traceback
+
+from .client import MailClient
+from .common_util import decrypt
+from . import verbose, info, idle_renew_period
+
+UNTAGGED_NEW_MAIL_RE = re.compile(r"^\*\s+\d+\s+(EXISTS|RECENT)\b", re.IGNORECASE)
+
+SELECT_TIMEOUT = 5 # Secs. Also the max delay before newly watched mailboxes are picked up.
+
+class IdleError(Exception):
+    pass
+
+class FdPoller(object):
+    """Waits for input on many file descriptors using select.epoll where available, else select.poll.
+    Unlike select.select, neither is limited to descriptors below FD_SETSIZE (1024)."""
+
+    def __init__(self):
+        if hasattr(select, 'epoll'):
+            self.poller = select.epoll()
+            self.mask = select.EPOLLIN | select.EPOLLERR | select.EPOLLHUP
+            self.timeout_scale = 1 # epoll takes secs...
+        else:
+            self.poller = select.poll()
+            self.mask = select.POLLIN | select.POLLERR | select.POLLHUP
+            self.timeout_scale = 1000 # ...and poll millisecs.
+
+    def register(self, fd):
+        self.poller.register(fd, self.mask)
+
+    def unregister(self, fd):
+        try:
+            self.poller.unregister(fd)
+        except (KeyError, IOError, OSError, ValueError):
+            pass # Never registered, or already closed, which removes it from epoll.
+
+    def poll(self, timeout):
+        """Returns the descriptors with input, or an error or hang up to be found on reading."""
+        while True:
+            try:
+                return [fd for fd, _ in self.poller.poll(timeout * self.timeout_scale)]
+            except (select.error, IOError), e:
+                if e.args and e.args[0] == errno.EINTR:
+                    continue
+                raise
+
+class IdleSession(object):
+    """IDLE (RFC 2177) on a dedicated connection of one mailbox.
+
+    Once IDLE starts imaplib's reader is not used. The socket is read directly, so that many
+    sessions can wait together on one select().
+    """
+
+    def __init__(self, usermail, client):
+        self.usermail = usermail
+        self.client = client
+        self.tag = None
+        self.buf = ''
+        self.started_at = 0
+
+    def sock(self):
+        mail = self.client.mail
+        return getattr(mail, 'sslobj', None) or mail.socket()
+
+    def fileno(self):
+        return self.sock().fileno()
+
+    def _recv(self):
+        sock = self.sock()
+        data = sock.recv(4096)
+        if not data:
+            raise IdleError('Connection closed by server.')
+        # Decrypted bytes buffered inside the SSL object are not visible to select().
+        while hasattr(sock, 'pending') and sock.pending():
+            data += sock.recv(sock.pending())
+        return data
+
+    def _read_line(self):
+        while '\r\n' not in self.buf:
+            self.buf += self._recv()
+        line, self.buf = self.buf.split('\r\n', 1)
+        return line
+
+    def start(self):
+        mail = self.client.mail
+        self.tag = mail._new_tag()
+        mail.send('%s IDLE\r\n' % self.tag)
+        while True:
+            line = self._read_line()
+            if line.startswith('+'):
+                break
+            if line.startswith(self.tag):
+                raise IdleError('Server refused IDLE: %s' % line)
+        self.started_at = time.time()
+
+    def stop(self):
+        """Ends IDLE. Returns True if new mail was reported meanwhile."""
+        self.client.mail.send('DONE\r\n')
+        has_new = False
+        while True:
+            line = self._read_line()
+            if UNTAGGED_NEW_MAIL_RE.match(line):
+                has_new = True
+            elif line.startswith(self.tag):
+                tag, self.tag = self.tag, None
+                if not line[len(tag):].strip().upper().startswith('OK'):
+                    raise IdleError('IDLE ended with: %s' % line)
+                return has_new
+
+    def renew_if_due(self):
+        """Servers may drop connections idling for 30 mins. So IDLE is restarted before that.
+        Returns True if new mail was reported meanwhile."""
+        if time.time() - self.started_at >= idle_renew_period:
+            if verbose: print 'Renewing IDLE of', self.usermail.email
+            has_new = self.stop()
+            self.start()
+            return has_new
+        return False
+
+    def read_events(self):
+        """Reads whatever is available. Returns True if the server reported new mail."""
+        self.buf += self._recv()
+        has_new = False
+        while '\r\n' in self.buf:
+            line, self.buf = self.buf.split('\r\n', 1)
+            if verbose: print 'IDLE %s: %s' % (self.usermail.email, line)
+            if UNTAGGED_NEW_MAIL_RE.match(line):
+                has_new = True
+        return has_new
+
+    def close(self):
+        try:
+            if self.tag:
+                self.stop()
+        except Exception, e:
+            if verbose: print 'Error in ending IDLE.', e
+        self.client.close_connection()
+
+class IdleListener(object):
+    """Holds the IDLE connections of many mailboxes and waits on all of them in one thread.
+
+    on_new_mail(usermail) is called when a mailbox reports new mail and on_dropped(usermail) when
+    its IDLE connection fails, so that the mailbox can go back to being polled.
+    """
+
+    def __init__(self, on_new_mail, on_dropped=None):
+        self.on_new_mail = on_new_mail
+        self.on_dropped = on_dropped
+        self.sessions = dict() # usermail id -> IdleSession
+        self.to_close = [] # Unwatched sessions. Closed by the listener thread, which owns their sockets.
+        self.lock = threading.Lock()
+        self.thread = None
+        # Only used by the listener thread.
+        self.poller = FdPoller()
+        self.fd_sessions = dict() # fd -> IdleSession registered with poller
+        self.session_fds = dict() # IdleSession -> fd
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name='idle-listener')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def is_watching(self, usermail):
+        with self.lock:
+            return usermail.id in self.sessions
+
+    def watch(self, usermail, last_uid=None):
+        """Opens a dedicated connection for usermail and starts IDLE on it. Returns False if the
+        server does not support IDLE. IDLE reports only the mail arriving after it starts. So when
+        the inbox already has uids beyond last_uid, the last one processed, on_new_mail is called."""
+        if self.is_watching(usermail):
+            return True
+
+        client = MailClient(usermail.in_mail_config, usermail.out_mail_config,
+            usermail.email, decrypt(usermail.password, True))
+        client.defer_retries = True # Called by poller workers, which must not sleep in retries.
+        client.use_compress = False # IdleSession reads the socket directly.
+        client.open_connection()
+        if not client.has_capability('IDLE'):
+            client.close_connection()
+            return False
+
+        session = IdleSession(usermail, client)
+        try:
+            session.start()
+        except Exception:
+            session.close()
+            raise
+        with self.lock:
+            self.sessions[usermail.id] = session
+        if info: print 'Watching %s using IDLE.' % usermail.email
+        if last_uid is not None and (client.uid_next is None or client.uid_next > last_uid + 1):
+            self.on_new_mail(usermail) # Mail may have come between the poll and the start of IDLE.
+        return True
+
+    def unwatch(self, usermail_id):
+        with self.lock:
+            session = self.sessions.pop(usermail_id, None)
+            if session:
+                self.to_close.append(session)
+
+    def retain(self, usermail_ids):
+        """Stops watching the mailboxes not in usermail_ids."""
+        with self.lock:
+            gone = [i for i in self.sessions if i not in usermail_ids]
+        for i in gone:
+            self.unwatch(i)
+
+    def _register(self, session):
+        fd = session.fileno()
+        self.poller.register(fd)
+        self.fd_sessions[fd] = session
+        self.session_fds[session] = fd
+
+    def _unregister(self, session):
+        fd = self.session_fds.pop(session, None)
+        if fd is not None:
+            self.poller.unregister(fd)
+            del self.fd_sessions[fd]
+
+    def _close(self, session):
+        self._unregister(session) # Before the fd gets closed and maybe reused.
+        session.close()
+
+    def _drop(self, session, e):
+        print '>>> IDLE failed for %s: %s' % (session.usermail.email, e)
+        with self.lock:
+            if self.sessions.get(session.usermail.id) is session:
+                del self.sessions[session.usermail.id]
+        self._close(session)
+        if self.on_dropped:
+            self.on_dropped(session.usermail)
+
+    def _is_current(self, session):
+        with self.lock:
+            return self.sessions.get(session.usermail.id) is session
+
+    def _sync_registrations(self, sessions):
+        """Registers the newly watched sessions with the poller and unregisters the ones gone."""
+        current = set(sessions)
+        for session in [x for x in self.session_fds if x not in current]:
+            self._unregister(session)
+        for session in sessions:
+            if session not in self.session_fds:
+                try:
+                    self._register(session)
+                except Exception, e:
+                    self._drop(session, e)
+
+    def _run(self):
+        while True:
+            with self.lock:
+                to_close, self.to_close = self.to_close, []
+            for session in to_close:
+                self._close(session)
+            with self.lock:
+                sessions = self.sessions.values()
+            self._sync_registrations(sessions)
+            if not self.session_fds:
+                time.sleep(SELECT_TIMEOUT)
+                continue
+
+            readable = set()
+            for fd in self.poller.poll(SELECT_TIMEOUT):
+                session = self.fd_sessions.get(fd, None)
+                if session is None or not self._is_current(session):
+                    continue
+                readable.add(session)
+                try:
+                    if session.read_events():
+                        self.on_new_mail(session.usermail)
+                except Exception, e:
+                    if verbose: print traceback.format_exc()
+                    self._drop(session, e)
+
+            for session in self.session_fds.keys():
+                if session not in readable and self._is_current(session):
+                    try:
+                        if session.renew_if_due():
+                            self.on_new_mail(session.usermail)
+                    except Exception, e:
+                        self._drop(session, e)
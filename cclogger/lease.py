@@ -0,0 +1,100 @@
+import datetime
+import math
+import os
+import socket
+
+from .model import db, UserMail, Poller
+from . import verbose, info
+
+class LeaseManager(object):
+    """Splits the mail boxes among parallel poller instances using leases on the UserMail rows.
+
+    Every cycle a poller renews its leases, then claims expired or unowned mail boxes, or releases
+    its extra ones, till it holds its fair share (pollable mail boxes / live pollers). A poller
+    that dies stops renewing, so its leases expire and the live ones take them over.
+    All times are UTC, hence the hosts' clocks must be in sync.
+    """
+
+    def __init__(self, lease_period, name=None):
+        self.lease_period = datetime.timedelta(seconds=lease_period)
+        self.renew_margin = self.lease_period / 4 # Leases closer than this to expiry are renewed before a poll.
+        self.name = name or '%s:%d' % (socket.gethostname(), os.getpid())
+        self.expiries = dict() # usermail id -> expiry of the lease held on it
+
+    def heartbeat(self, now):
+        with db.transaction():
+            updated = Poller.update(heartbeat=now).where(Poller.name == self.name).execute()
+            if not updated:
+                Poller.create(name=self.name, heartbeat=now)
+
+    def count_live_pollers(self, now):
+        return Poller.select().where(Poller.heartbeat > now - self.lease_period).count()
+
+    def is_mine(self, now):
+        return (UserMail.lease_owner == self.name) & (UserMail.lease_expiry > now)
+
+    def is_free(self, now):
+        return (UserMail.lease_owner >> None) | (UserMail.lease_expiry >> None) | (UserMail.lease_expiry <= now)
+
+    def claim(self):
+        """Renews, claims and releases leases. Returns the mail boxes this poller must check now."""
+        now = datetime.datetime.utcnow()
+        expiry = now + self.lease_period
+        self.heartbeat(now)
+        # Pollers which crashed never delete their rows. Else the table would only grow.
+        Poller.delete().where(Poller.heartbeat <= now - self.lease_period).execute()
+
+        UserMail.update(lease_expiry=expiry).where(self.is_mine(now)).execute()
+
+        total = UserMail.select_pollable().count()
+        fair_share = int(math.ceil(float(total) / max(1, self.count_live_pollers(now))))
+        mine = UserMail.select_pollable().where(self.is_mine(now)).count()
+
+        if mine > fair_share:
+            # A poller joined. Give away the extra ones, they get picked up in its next cycle.
+            ids = [u.id for u in UserMail.select_pollable().where(self.is_mine(now)).limit(mine - fair_share)]
+            self.release(ids)
+        elif mine < fair_share:
+            ids = [u.id for u in UserMail.select_pollable().where(self.is_free(now)).limit(fair_share - mine)]
+            if ids:
+                # The lease condition is checked again, so rows another poller just took are left alone.
+                claimed = UserMail.update(lease_owner=self.name, lease_expiry=expiry) \
+                    .where((UserMail.id << ids) & self.is_free(now)).execute()
+                if verbose: print 'Poller %s claimed %d mail boxes.' % (self.name, claimed)
+
+        usermails = list(UserMail.select_pollable().where(self.is_mine(now)))
+        self.expiries = dict((u.id, expiry) for u in usermails)
+        if info:
+            print 'Poller %s holds leases of %d/%d mail boxes (fair share %d).' % (self.name,
+                len(usermails), total, fair_share)
+        return usermails
+
+    def holds(self, usermail):
+        """Tells if this poller still holds the lease of usermail, renewing it when it is about to expire.
+        Called before each poll, since a poll cycle can outlast lease_period."""
+        now = datetime.datetime.utcnow()
+        expiry = self.expiries.get(usermail.id, None)
+        if expiry is not None and now < expiry - self.renew_margin:
+            return True
+
+        expiry = now + self.lease_period
+        renewed = UserMail.update(lease_expiry=expiry).where((UserMail.id == usermail.id) & self.is_mine(now)).execute()
+        if renewed:
+            self.expiries[usermail.id] = expiry
+        else:
+            self.expiries.pop(usermail.id, None) # Lapsed, and maybe taken over by another poller.
+        return bool(renewed)
+
+    def release(self, ids=None):
+        """Releases the given leases, or all of them when ids is None."""
+        q = UserMail.update(lease_owner=None, lease_expiry=None).where(UserMail.lease_owner == self.name)
+        if ids is not None:
+            if not ids:
+                return
+            q = q.where(UserMail.id << ids)
+        q.execute()
+
+    def shutdown(self):
+        """Lets the other pollers take over right away instead of waiting for the leases to expire."""
+        self.release()
+        Poller.delete().where(Poller.name == self.name).execute()
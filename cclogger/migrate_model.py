@@ -0,0 +1,35 @@
+"""Brings the tables of an existing install up to date with the models without losing their data.
+setup_model drops and recreates all the tables, so it is only for new installs. Upgrade with
+python -m cclogger.migrate_model before starting the new poller. Running it again does nothing."""
+from .model import InMailServerConfig, UserMail, Poller, OutboxMail
+from . import info
+
+def get_columns(model):
+    db = model._meta.database
+    cursor = db.execute_sql('SELECT * FROM %s LIMIT 0' % db.compiler().quote(model._meta.db_table))
+    return set(d[0] for d in cursor.description)
+
+def add_columns(model, *fields):
+    """Adds the columns of fields which the table of model lacks, along with their indexes."""
+    db = model._meta.database
+    qc = db.compiler()
+    columns = get_columns(model)
+    for field in fields:
+        if field.db_column in columns:
+            continue
+        sql = 'ALTER TABLE %s ADD COLUMN %s' % (qc.quote(model._meta.db_table), qc.field_sql(field))
+        if field.default is not None:
+            sql += ' DEFAULT %d' % field.default # Fills in the existing rows. Only numbers and booleans are added.
+        if info: print sql
+        db.execute_sql(sql)
+        if field.index or field.unique:
+            db.create_index(model, [field], field.unique)
+
+def migrate():
+    add_columns(InMailServerConfig, InMailServerConfig.use_compress)
+    add_columns(UserMail, UserMail.last_uid, UserMail.uid_validity, UserMail.lease_owner, UserMail.lease_expiry)
+    Poller.create_table(fail_silently=True)
+    OutboxMail.create_table(fail_silently=True)
+
+if __name__ == '__main__':
+    migrate()
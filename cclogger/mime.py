@@ -0,0 +1,107 @@
+import binascii
+import codecs
+import email.parser
+import quopri
+
+header_parser = email.parser.HeaderParser()
+
+def find_header_end(raw, start, end):
+    """Returns (end of headers, start of body) of the MIME entity in raw[start:end]."""
+    if raw.startswith('\r\n', start):
+        return start, start + 2
+    if raw.startswith('\n', start):
+        return start, start + 1
+    crlf = raw.find('\r\n\r\n', start, end)
+    lf = raw.find('\n\n', start, end)
+    if crlf != -1 and (lf == -1 or crlf < lf):
+        return crlf + 2, crlf + 4
+    if lf != -1:
+        return lf + 1, lf + 2
+    return end, end # Headers only, or truncated within the headers.
+
+def find_delimiter(raw, delimiter, start, end):
+    if raw.startswith(delimiter, start):
+        return start
+    pos = raw.find('\n' + delimiter, start, end)
+    return -1 if pos == -1 else pos + 1
+
+def iter_body_parts(raw, start, end, boundary):
+    """Yields (start, end) of the body parts of a multipart entity in raw[start:end]. Only the
+    delimiter lines are looked at, the parts themselves are not copied."""
+    delimiter = '--' + boundary
+    pos = find_delimiter(raw, delimiter, start, end)
+    while pos != -1:
+        if raw.startswith('--', pos + len(delimiter)):
+            return # Close delimiter.
+        line_end = raw.find('\n', pos, end)
+        if line_end == -1:
+            return
+        part_start = line_end + 1
+        pos = find_delimiter(raw, delimiter, part_start, end)
+        if pos == -1:
+            yield part_start, end # No close delimiter. The mail was truncated.
+            return
+        # The line break before a delimiter belongs to the delimiter.
+        part_end = pos - 1
+        if part_end > part_start and raw[part_end - 1] == '\r':
+            part_end -= 1
+        yield part_start, max(part_start, part_end)
+
+class MimeEntity(object):
+    """Headers of a MIME entity, plus where its body lies in the raw mail."""
+
+    def __init__(self, raw, start=0, end=None):
+        end = len(raw) if end is None else end
+        header_end, self.body_start = find_header_end(raw, start, end)
+        self.headers = header_parser.parsestr(raw[start:header_end])
+        self.raw = raw
+        self.body_end = end
+
+    def get_body(self):
+        return self.raw[self.body_start:self.body_end]
+
+    def get_decoded_body(self):
+        """Body with its transfer encoding and charset decoded, as unicode."""
+        body = self.get_body()
+        encoding = (self.headers.get('Content-Transfer-Encoding') or '').strip().lower()
+        if encoding == 'base64':
+            body = ''.join(body.split())
+            # When truncated by max_mail_size only the complete 4 char groups can be decoded.
+            body = binascii.a2b_base64(body[:len(body) - len(body) % 4])
+        elif encoding == 'quoted-printable':
+            body = quopri.decodestring(body)
+
+        charset = self.headers.get_content_charset() or 'utf-8' # utf-8 is a superset of the us-ascii default.
+        try:
+            codecs.lookup(charset)
+        except LookupError:
+            charset = 'utf-8'
+        return body.decode(charset, 'replace')
+
+    def is_attachment(self):
+        return (self.headers.get('Content-Disposition') or '').strip().lower().startswith('attachment')
+
+    def get_parts(self):
+        boundary = self.headers.get_boundary()
+        if not boundary:
+            return
+        for start, end in iter_body_parts(self.raw, self.body_start, self.body_end, boundary):
+            yield MimeEntity(self.raw, start, end)
+
+def find_body_entities(entity, found=None):
+    """Walks the MIME tree, nested multiparts included, for the first text/html and the first
+    text/plain parts. Returns them as [html entity, text entity], either can be None. Other parts,
+    like attachments, are skipped without parsing them."""
+    found = found or [None, None]
+    if entity.headers.get_content_maintype() == 'multipart':
+        for part in entity.get_parts():
+            find_body_entities(part, found)
+            if found[0] and found[1]:
+                break
+    elif not entity.is_attachment():
+        content_type = entity.headers.get_content_type()
+        if content_type == 'text/html' and found[0] is None:
+            found[0] = entity
+        elif content_type == 'text/plain' and found[1] is None:
+            found[1] = entity
+    return found
@@ -14,7 +14,7 @@ if db_pass:
 if verbose: print 'Instantiating DB with: %s/%s@%s:%s' % (db_user if db_user else 'x', db_pass if db_pass else 'x',
     db_host if db_host else 'x', str(db_port) if db_port else 'x')
 
-db = peewee.MySQLDatabase(db_name, **db_args)
+db = peewee.MySQLDatabase(db_name, threadlocals=True, **db_args) # Each poller worker thread gets its own connection.
 
 class BaseModel(peewee.Model):
     class Meta:
@@ -30,7 +30,7 @@ class BaseMailServerConfig(BaseModel):
         return u"%s (%s)" % (self.at_domain, self.conf_type)
 
 class InMailServerConfig(BaseMailServerConfig):
-    pass
+    use_compress = peewee.BooleanField(default=True) # Use COMPRESS=DEFLATE when the server supports it.
 
 class OutMailServerConfig(BaseMailServerConfig):
     pass
@@ -65,18 +65,33 @@ class UserMail(BaseModel):
     is_dummy = peewee.BooleanField() # If true then do not check mails of this id. This is meant only for authentication.
     is_bad = peewee.BooleanField(default=False)
     error = peewee.CharField(max_length=100, null=True)
-    #partition = peewee.CharField(max_length=5) # For future extension so that different parallel instances can check disjoint batches of mail boxes.
     is_sms = peewee.BooleanField(db_index=True, default=False)
+    last_uid = peewee.BigIntegerField(default=0) # Highest inbox UID already processed by the poller.
+    uid_validity = peewee.BigIntegerField(null=True) # Inbox UIDVALIDITY last_uid belongs to.
+    # Parallel poller instances check disjoint batches of mail boxes. Each claims its batch by leasing the rows.
+    lease_owner = peewee.CharField(max_length=100, null=True, db_index=True) # Name of the poller holding the lease.
+    lease_expiry = peewee.DateTimeField(null=True) # UTC
 
     def __unicode__(self):
         return u'%s (is_sms:%s)' % (self.email, str(self.is_sms))
 
+    @classmethod
+    def select_pollable(cls):
+        return cls.select().where(cls.is_dummy == False, cls.is_bad == False, cls.is_sms == False)
+
     class Meta:
         indexes = (
             (('email', 'password'), False),
             (('is_dummy', 'is_bad'), False),
             )
 
+class Poller(BaseModel):
+    name = peewee.CharField(unique=True, max_length=100)
+    heartbeat = peewee.DateTimeField(db_index=True) # UTC. Pollers not heard from for a lease period are dead.
+
+    def __unicode__(self):
+        return u'%s (%s)' % (self.name, self.heartbeat)
+
 class UserMailMap(BaseModel):
     user = peewee.ForeignKeyField(User, db_index=True, cascade=True)
     user_mail = peewee.ForeignKeyField(UserMail, cascade=True)
@@ -126,3 +141,16 @@ class TransactionAlert(BaseModel):
             (('card_no', 'currency', 'place'), False),
             )
 
+class OutboxMail(BaseModel):
+    """Mail waiting to be sent from the server email by the background sender."""
+    to_addresses = peewee.TextField() # Comma separated. e.g. Name1<a@x.com>, Name2<b@y.com>
+    subject = peewee.CharField(max_length=255)
+    body = peewee.TextField() # html
+    is_admin_alert = peewee.BooleanField(default=False) # Admin alerts close in time are sent as one digest.
+    created = peewee.DateTimeField(db_index=True) # UTC
+    attempts = peewee.IntegerField(default=0)
+    claimed_by = peewee.CharField(max_length=100, null=True, db_index=True) # Name of the sender sending it.
+    claim_expiry = peewee.DateTimeField(null=True) # UTC. After this other senders may take it over.
+
+    def __unicode__(self):
+        return u'%s => %s' % (self.subject, self.to_addresses)
@@ -0,0 +1,135 @@
+import datetime
+import email.utils
+import os
+import socket
+import threading
+import time
+import traceback
+
+from .client import server_send_mail
+from .model import db, OutboxMail
+from . import info, admin_emails, admin_digest_window, outbox_poll_period, outbox_max_attempts, \
+    outbox_claim_period
+
+def addresses_to_str(to):
+    return ', '.join(['%s<%s>' % (t[0], t[1]) if isinstance(t, (tuple, list)) else str(t) for t in to])
+
+def queue_server_mail(to, subject, html_body, is_admin_alert=False):
+    """Saves the mail to be sent by the OutboxSender. to is a list of (name, email) tuples.
+    If the mail cannot be queued it is sent right away."""
+    try:
+        OutboxMail.create(to_addresses=addresses_to_str(to), subject=subject[:255], body=html_body,
+            is_admin_alert=is_admin_alert, created=datetime.datetime.utcnow())
+    except Exception, e:
+        print '>>> Could not queue mail. Sending it now. Error: ', str(e)
+        server_send_mail(to, subject, html_body)
+
+def queue_admin_alert(subject, html_body):
+    if admin_emails:
+        queue_server_mail(admin_emails, subject, html_body, is_admin_alert=True)
+
+def make_digest(alerts):
+    """Makes one mail out of many admin alerts. Alerts with the same subject are listed once with their count."""
+    by_subject = []
+    counts = dict()
+    for alert in alerts:
+        if alert.subject not in counts:
+            by_subject.append(alert)
+            counts[alert.subject] = 0
+        counts[alert.subject] += 1
+
+    subject = 'CCTracker: %d alerts' % len(alerts)
+    body = ''.join(['<h3>%s (x%d)</h3>\n%s\n<hr/>\n' % (a.subject, counts[a.subject], a.body) for a in by_subject])
+    return subject, body
+
+class OutboxSender(object):
+    """Background thread sending the queued mails, so that the poller never waits on SMTP.
+
+    Admin alerts are held till the oldest of them is admin_digest_window secs old and then all
+    pending ones go out as one digest. A mail failing outbox_max_attempts times is dropped.
+
+    Pollers share the queue, so each sender first claims the mails it is about to send, the same way
+    LeaseManager claims mail boxes, and sends only those. A claim lapses after outbox_claim_period
+    secs, so that the mails claimed by a sender which died still go out.
+    """
+
+    def __init__(self, name=None):
+        self.thread = None
+        self.name = name or '%s:%d' % (socket.gethostname(), os.getpid())
+        # Claims are per sender, not per thread. So the thread and a flush on shutdown must not drain together.
+        self.lock = threading.Lock()
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name='outbox-sender')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.drain()
+            except Exception, e:
+                print '>>> Exception in outbox sender: ', str(e)
+                print traceback.format_exc()
+                if not db.is_closed():
+                    db.close() # Reconnects on next use.
+            time.sleep(outbox_poll_period)
+
+    def _send(self, mails, subject, body):
+        to = email.utils.getaddresses([mails[0].to_addresses])
+        ids = [m.id for m in mails]
+        try:
+            server_send_mail(to, subject, body)
+        except Exception, e:
+            print '>>> Could not send queued mail "%s": %s' % (subject, e)
+            OutboxMail.update(attempts=OutboxMail.attempts + 1, claimed_by=None, claim_expiry=None) \
+                .where(OutboxMail.id << ids).execute()
+            OutboxMail.delete().where((OutboxMail.id << ids) & (OutboxMail.attempts >= outbox_max_attempts)).execute()
+            return
+        OutboxMail.delete().where(OutboxMail.id << ids).execute()
+
+    def is_mine(self, now):
+        return (OutboxMail.claimed_by == self.name) & (OutboxMail.claim_expiry > now)
+
+    def is_free(self, now):
+        return (OutboxMail.claimed_by >> None) | (OutboxMail.claim_expiry >> None) | (OutboxMail.claim_expiry <= now)
+
+    def claim(self, flush=False):
+        """Claims the mails due to be sent. Admin alerts are claimed only once the digest window of the oldest
+        one has closed, or when flush. Returns the mails this sender holds, oldest first."""
+        now = datetime.datetime.utcnow()
+        window_start = now - datetime.timedelta(seconds=admin_digest_window)
+        q = OutboxMail.update(claimed_by=self.name, claim_expiry=now + datetime.timedelta(seconds=outbox_claim_period))
+        if flush or OutboxMail.select().where((OutboxMail.is_admin_alert == True) & self.is_free(now)
+                & (OutboxMail.created <= window_start)).exists():
+            q = q.where(self.is_free(now))
+        else:
+            q = q.where((OutboxMail.is_admin_alert == False) & self.is_free(now))
+        # Only free mails are updated, so two senders never both claim a mail.
+        q.execute()
+        return list(OutboxMail.select().where(self.is_mine(now)).order_by(OutboxMail.created))
+
+    def drain(self, flush=False):
+        """Sends the queued mails. Admin alerts still within the digest window are held back, unless flush."""
+        with self.lock:
+            self._drain(flush)
+
+    def _drain(self, flush):
+        pending = self.claim(flush)
+        alerts = [m for m in pending if m.is_admin_alert]
+
+        for mail in pending:
+            if not mail.is_admin_alert:
+                self._send([mail], mail.subject, mail.body)
+
+        if alerts:
+            by_to = dict() # Admins list may have changed between alerts.
+            for alert in alerts:
+                by_to.setdefault(alert.to_addresses, []).append(alert)
+            for to_alerts in by_to.values():
+                if len(to_alerts) == 1:
+                    self._send(to_alerts, to_alerts[0].subject, to_alerts[0].body)
+                else:
+                    subject, body = make_digest(to_alerts)
+                    if info: print 'Sending digest of %d admin alerts.' % len(to_alerts)
+                    self._send(to_alerts, subject, body)
@@ -1,7 +1,14 @@
 import re
+import threading
 
 from . import verbose
 from .common_util import ApiException
+from .prefilter import AnchorIndex
+
+SMS_LINE_BREAK_RE = re.compile(r"\n\r")
+SMS_SPACES_RE = re.compile(r"\s{2,}")
+# Sms sender ids look like LM-CITIBK, the first two letters telling the operator and circle it came through.
+SMS_SENDER_PREFIX_RE = re.compile(r"^[a-z0-9]{2}-")
 
 class ParserWarning(Exception):
     def __init__(self, tag, code, msg, cc_no=None):
@@ -29,9 +36,72 @@ class ParserWarning(Exception):
 class ParserException(ParserWarning):
     pass
 
+class ParserPattern(object):
+    """A regex of a parser, compiled once when the parser registers, which counts its matches and misses."""
+
+    def __init__(self, tag, name, pattern, flags=0, groups=()):
+        try:
+            self.regex = re.compile(pattern, flags)
+        except re.error, e:
+            raise ValueError('Pattern %s of parser %s does not compile: %s' % (name, tag, e))
+        missing = set(groups) - set(self.regex.groupindex)
+        if missing:
+            raise ValueError('Pattern %s of parser %s lacks the groups %s.' % (name, tag, ', '.join(sorted(missing))))
+        self.tag = tag
+        self.name = name
+        self.matches = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def _count(self, m):
+        with self.lock:
+            if m:
+                self.matches += 1
+            else:
+                self.misses += 1
+        return m
+
+    def match(self, string):
+        return self._count(self.regex.match(string))
+
+    def search(self, string):
+        return self._count(self.regex.search(string))
+
+class PatternRegistry(object):
+    """All compiled parser patterns, by parser name and pattern name."""
+
+    def __init__(self):
+        self.patterns = dict() # (tag, name) -> ParserPattern
+        self.lock = threading.Lock()
+
+    def register(self, tag, name, pattern, flags=0, groups=()):
+        compiled = ParserPattern(tag, name, pattern, flags, groups)
+        with self.lock:
+            self.patterns[(tag, name)] = compiled
+        return compiled
+
+    def get_stats(self):
+        """Returns {parser name: {pattern name: {'matches': .., 'misses': ..}}}."""
+        stats = dict()
+        with self.lock:
+            patterns = self.patterns.values()
+        for p in patterns:
+            stats.setdefault(p.tag, dict())[p.name] = {'matches': p.matches, 'misses': p.misses}
+        return stats
+
+pattern_registry = PatternRegistry()
+
+def normalize_sms_body(body):
+    body = SMS_LINE_BREAK_RE.sub("", body.strip())
+    return SMS_SPACES_RE.sub(" ", body) # Removes multiple spaces
+
+def sms_sender_key(address):
+    "The bank part of an sms sender id, so that LM-Citibk and AD-CITIBK are taken as the same sender."
+    return SMS_SENDER_PREFIX_RE.sub("", address.strip().lower())
+
 class BaseParseCentral(object):
     INSTANCE = None
-    parsers = dict()
+    parsers = None # Each central has its own, else sms senders would be searched for in the mail boxes.
 
     def __init__(self):
         if self.INSTANCE is not None:
@@ -45,6 +115,8 @@ class BaseParseCentral(object):
         return self.parsers
 
 class ParseCentral(BaseParseCentral):
+    parsers = dict() # from email -> parser
+
     @classmethod
     def getInstance(cls):
         if cls.INSTANCE is None:
@@ -62,13 +134,22 @@ class ParseCentral(BaseParseCentral):
             if verbose:
                 print 'Registered parser for email: ', email
 
+    def get_tracked_from_emails(self):
+        """Sender addresses some parser is interested in. Mails from others need not be fetched."""
+        return sorted(self.parsers.keys())
+
+    def is_candidate(self, from_email, subject):
+        """Tells from just the sender and subject if the mail may be an alert, so that its body is worth downloading."""
+        parser = self.parsers.get(from_email.strip().lower(), None)
+        return parser is not None and parser.is_alert_subject(subject or '')
+
     def parse(self, mail, uid, usermail):
         from_email = mail['From'][1].strip().lower()
         parser = self.parsers.get(from_email, None)
         if parser:
             try:
                 return parser.parse_mail(from_email, mail['To'], mail['Date'], mail['DateTzinfo'],
-                    mail['Subject'], mail['Body'], uid, usermail)
+                    mail['Subject'], mail['Body'], uid, usermail, text=mail['Text'])
             except ParserException:
                 # Todo log them into notifications table and create api to access that.
                 pass
@@ -77,8 +158,14 @@ class ParseCentral(BaseParseCentral):
                 print 'No parser found for from_email: ', from_email
 
 class SmsParseCentral(BaseParseCentral):
+    """Dispatches each sms to the parsers of its sender, and to only those of their rules whose anchor phrase
+    is in the sms. All anchors are looked for in one pass, so the cost per sms does not grow with the rules."""
+    parsers = dict() # sms sender address -> parser
     parsers_addresses = list()
     parser_name_to_parser_map = dict()
+    sender_parsers = dict() # sms_sender_key -> parsers
+    unanchored_rules = dict() # parser name -> rule names to always try
+    anchor_index = AnchorIndex() # Finds (parser name, rule name) of the anchors in a sms.
 
     @classmethod
     def getInstance(cls):
@@ -97,9 +184,28 @@ class SmsParseCentral(BaseParseCentral):
             address = address.strip().lower()
             self.parsers[address] = parser
             self.parsers_addresses.append(address)
+            parsers = self.sender_parsers.setdefault(sms_sender_key(address), list())
+            if parser not in parsers:
+                parsers.append(parser)
             if verbose:
                 print 'Registered sms parser for address: ', address
 
+        anchors = parser.get_anchors()
+        if anchors is not None:
+            unanchored = self.unanchored_rules[parser.get_name()] = list()
+            for rule, anchor in anchors:
+                if anchor:
+                    self.anchor_index.add(anchor, (parser.get_name(), rule))
+                else:
+                    unanchored.append(rule)
+
+    def get_candidate_rules(self, parser, found):
+        "Rule names of parser worth trying given the found anchors, or None for all of them."
+        unanchored = self.unanchored_rules.get(parser.get_name(), None)
+        if unanchored is None:
+            return None
+        return set(rule for name, rule in found if name == parser.get_name()).union(unanchored)
+
     def get_addresses_interested(self):
         return self.parsers_addresses
 
@@ -116,49 +222,75 @@ class SmsParseCentral(BaseParseCentral):
 
     def parse(self, from_address, body, date, tzinfo, smsid, usermail):
         from_address = from_address.strip().lower()
-        parser = self.parsers.get(from_address, None)
-        if parser:
-            body = body.strip()
-            body = re.sub(r"\n\r", "", body)
-            body = re.sub(r"\s{2,}", " ", body) # Removes multiple spaces
-            try:
-                return parser.parse_sms(from_address, body, date, tzinfo, smsid, usermail)
-            except ParserException, e:
-                a = ApiException('PARSE_FAILED', unicode(e))
-                a.set_extra({
-                    'Smsid': smsid
-                    })
-                raise a
-            except ParserWarning, w:
-                return w
+        parsers = self.sender_parsers.get(sms_sender_key(from_address), None)
+        if parsers:
+            body = normalize_sms_body(body)
+            found = self.anchor_index.find(body)
+            warning = None
+            for parser in parsers:
+                rules = self.get_candidate_rules(parser, found)
+                if rules is not None and not rules:
+                    continue
+                try:
+                    if parser.parse_sms(from_address, body, date, tzinfo, smsid, usermail, rules=rules):
+                        return True
+                except ParserException, e:
+                    a = ApiException('PARSE_FAILED', unicode(e))
+                    a.set_extra({
+                        'Smsid': smsid
+                        })
+                    raise a
+                except ParserWarning, w:
+                    warning = w
+            return warning or ParserWarning(parsers[0].get_name(), 'BODY_PRASE_WARN', 'Could not parse sms body.')
         else:
             if verbose:
                 print 'No parser found for from_address: ', from_address
 
 class BaseParser(object):
+    # Pattern name -> (regex, flags, required group names). Compiled into self.patterns on registration.
+    PATTERNS = dict()
 
     def get_name(self):
         "Must be unique for each kind of parsers."
         raise NotImplementedError
 
+    def compile_patterns(self):
+        self.patterns = dict()
+        for name, spec in self.PATTERNS.items():
+            self.patterns[name] = pattern_registry.register(self.get_name(), name, *spec)
+
 class AlertMailParser(BaseParser):
     def __init__(self):
+        self.compile_patterns()
         ParseCentral.getInstance().register(self)
 
     def get_from_emails_to_track(self):
         raise NotImplementedError
 
-    def parse_mail(self, from_email, to_email, date, tzinfo, subject, body, uid, usermail):
+    def is_alert_subject(self, subject):
+        "Override to skip downloading mails whose subject shows they can't be parsed."
+        return True
+
+    def parse_mail(self, from_email, to_email, date, tzinfo, subject, body, uid, usermail, text=None):
+        "body is the decoded html of the mail and text its plain text. Parse text unless the markup matters."
         raise NotImplementedError
 
 class SmsParser(BaseParser):
     def __init__(self):
+        self.compile_patterns()
         SmsParseCentral.getInstance().register(self)
     
     def get_from_addresses_to_track(self):
         raise NotImplementedError
 
-    def parse_sms(self, from_address, body, date, tzinfo, smsid, usermail):
+    def get_anchors(self):
+        """List of (rule name, anchor phrase) of the parser's rules. A rule is tried only on sms containing its
+        anchor, or on all if its anchor is None. Return None to be given every sms of the tracked senders."""
+        return None
+
+    def parse_sms(self, from_address, body, date, tzinfo, smsid, usermail, rules=None):
+        "rules are the names of the rules to try, all if None."
         raise NotImplementedError
 
 from .parsers import *
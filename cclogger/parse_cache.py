@@ -0,0 +1,66 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+from . import parse_cache_size
+
+# Parse outcomes. Fields come with the name of the rule that found them, warnings with the rule that failed, if any.
+FIELDS = 'fields'
+NOT_TRANSACTION = 'not_transaction'
+WARNING = 'warning'
+
+class ParseCache(object):
+    """Least recently used cache of parse outcomes, keyed by a hash of what the parser looked at. Only the
+    outcome is kept, e.g. the fields of an alert, so that a repeat of the same alert skips the patterns and the
+    html work but is still saved for its own mailbox and uid."""
+
+    def __init__(self, size):
+        self.size = size
+        self.outcomes = OrderedDict() # key -> outcome, least recently used first
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def make_key(*parts):
+        h = hashlib.sha1()
+        for part in parts:
+            if isinstance(part, unicode):
+                part = part.encode('utf-8')
+            h.update(part or '')
+            h.update('\0')
+        return h.digest()
+
+    def get(self, key):
+        with self.lock:
+            outcome = self.outcomes.pop(key, None)
+            if outcome is None:
+                self.misses += 1
+                return None
+            self.outcomes[key] = outcome
+            self.hits += 1
+            return outcome
+
+    def put(self, key, outcome):
+        if self.size <= 0:
+            return
+        with self.lock:
+            self.outcomes.pop(key, None)
+            self.outcomes[key] = outcome
+            while len(self.outcomes) > self.size:
+                self.outcomes.popitem(last=False)
+                self.evictions += 1
+
+    def get_stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': float(self.hits) / total if total else 0.0,
+                'evictions': self.evictions,
+                'size': len(self.outcomes)
+            }
+
+parse_cache = ParseCache(parse_cache_size)
@@ -0,0 +1,292 @@
+import json
+import os
+import re
+import sre_constants
+import sre_parse
+
+from ..parse import AlertMailParser, ParserException, ParserWarning, SmsParser
+from ..model import TransactionAlert, Place, db
+from ..common_util import date_str_to_datetime, convert_month_abbr_to_digits, make_float, normalize_place_name
+from ..html_text import normalize_text
+from ..parse_cache import parse_cache, FIELDS, NOT_TRANSACTION, WARNING
+from .. import verbose
+
+TEMPLATES_PATH = os.path.join(os.path.dirname(__file__), 'banks.json')
+
+ACTIONS = ('create', 'cancel')
+# TransactionAlert fields a create rule must fill, and the ones it may.
+REQUIRED_FIELDS = ('card_no', 'currency', 'amt', 'date', 'place')
+OPTIONAL_FIELDS = ('meta1',)
+MAX_NAME_LENGTH = 10 # Of TransactionAlert.created_by
+MIN_ANCHOR_LENGTH = 4
+
+def find_anchor(pattern):
+    """The longest run of literal characters at the top level of pattern, which any text it matches must contain.
+    None if there is no run of MIN_ANCHOR_LENGTH."""
+    best = run = ''
+    for op, av in sre_parse.parse(pattern, re.IGNORECASE):
+        if op == sre_constants.LITERAL and av < 128:
+            run += chr(av)
+        else:
+            run = ''
+        if len(run) > len(best):
+            best = run
+    return best.lower() if len(best) >= MIN_ANCHOR_LENGTH else None
+
+def select_text(html, selector):
+    """Normalised text of the elements of html matching the css selector, one per line. BeautifulSoup is
+    imported only here, so that only the templates navigating the markup pay for building a tree."""
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup(html)
+    return normalize_text(u'\n'.join(e.get_text(u' ') for e in soup.select(selector)))
+
+class TemplateRule(object):
+    """One kind of alert of a bank template. Its body pattern must match for the rule to apply. Its extra
+    patterns, keyed by the group they provide, are searched separately and fill None when missing. fields maps
+    TransactionAlert fields to group names. All patterns are case insensitive.
+
+    anchor is a phrase every body of the rule contains, used by SmsParseCentral to skip the rule for other sms.
+    It is taken from the body pattern when not given.
+
+    Mail rules match the text view of the mail, or with select, the text of the html elements matching that
+    css selector."""
+
+    def __init__(self, template_name, kind, spec):
+        self.name = spec.get('name', '')
+        self.action = spec.get('action', 'create')
+        self.subject = spec.get('subject', None)
+        self.body = spec.get('body', None)
+        self.extra = spec.get('extra', dict())
+        self.fields = spec.get('fields', dict())
+        self.date_format = spec.get('date_format', None)
+        self.anchor = spec.get('anchor', None)
+        self.select = spec.get('select', None)
+
+        where = 'Rule %s of template %s' % (self.name, template_name)
+        if not self.name or not self.body:
+            raise ValueError('%s needs a name and a body pattern.' % where)
+        if self.action not in ACTIONS:
+            raise ValueError('%s has unknown action %s.' % (where, self.action))
+        if (kind == 'mail') != (self.subject is not None):
+            raise ValueError('%s: mail rules need a subject pattern and sms rules cannot have one.' % where)
+        if kind != 'mail' and self.select is not None:
+            raise ValueError('%s: only mail rules can select html elements.' % where)
+        unknown = set(self.fields) - set(REQUIRED_FIELDS + OPTIONAL_FIELDS)
+        if unknown:
+            raise ValueError('%s maps unknown fields %s.' % (where, ', '.join(sorted(unknown))))
+        needed = REQUIRED_FIELDS if self.action == 'create' else ('meta1',)
+        missing = set(needed) - set(self.fields)
+        if missing:
+            raise ValueError('%s does not map the fields %s.' % (where, ', '.join(sorted(missing))))
+        if self.action == 'create' and not self.date_format:
+            raise ValueError('%s needs a date_format.' % where)
+        if self.anchor is None:
+            self.anchor = find_anchor(self.body)
+        else:
+            self.anchor = self.anchor.lower()
+            if not re.search(re.escape(self.anchor), self.body, re.IGNORECASE):
+                # Else a typo in the anchor would silently keep the rule from ever being tried.
+                raise ValueError('%s has anchor %s, which is not in its body pattern.' % (where, self.anchor))
+
+    def get_patterns(self):
+        "Pattern name -> (regex, flags, required groups), for BaseParser.PATTERNS."
+        patterns = dict()
+        if self.subject is not None:
+            patterns[self.name + '.subject'] = (self.subject, re.IGNORECASE)
+        body_groups = [g for g in self.fields.values() if g not in self.extra]
+        patterns[self.name + '.body'] = (self.body, re.IGNORECASE, body_groups)
+        for group, pattern in self.extra.items():
+            patterns[self.name + '.' + group] = (pattern, re.IGNORECASE, (group,))
+        return patterns
+
+    def match_subject(self, parser, subject):
+        return parser.patterns[self.name + '.subject'].match(subject)
+
+    def find_fields(self, parser, text, html=None):
+        "Returns the TransactionAlert fields found in text, or None if the body pattern does not match."
+        if self.select is not None:
+            text = select_text(html or u'', self.select)
+        m = parser.patterns[self.name + '.body'].search(text)
+        if not m:
+            return None
+        groups = m.groupdict()
+        for group in self.extra:
+            m = parser.patterns[self.name + '.' + group].search(text)
+            groups[group] = m.group(group) if m else None
+        return dict((field, groups[group]) for field, group in self.fields.items())
+
+    def parse_date(self, date, tzinfo):
+        date_format = self.date_format
+        if '%b' in date_format:
+            # strptime's %b depends on the locale.
+            date = convert_month_abbr_to_digits(date.upper())
+            date_format = date_format.replace('%b', '%m')
+        return date_str_to_datetime(date, date_format, tzinfo)
+
+    def save(self, parser, fields, uid, from_address, tzinfo, usermail):
+        "Saves or cancels the alert of fields, as found by find_fields."
+        if self.action == 'cancel':
+            refid = fields['meta1']
+            try:
+                trans = TransactionAlert.get(TransactionAlert.meta1 == refid,
+                    TransactionAlert.created_by == parser.get_name())
+            except TransactionAlert.DoesNotExist:
+                raise ParserException(parser.get_name(), 'CANCEL_FAIL',
+                    'Cannot cancel transaction with ref. id ' + refid + '. No such record found.')
+            trans.delete_instance()
+
+            if verbose:
+                print 'Successfully parsed and cancelled alert with reference id: ', refid
+            return True
+
+        place_name = normalize_place_name(fields['place'])
+        try:
+            place = Place.get(Place.place_name == place_name)
+        except Place.DoesNotExist:
+            place = Place.create(place_name=place_name)
+
+        trans = TransactionAlert.create(uid=uid, from_address=from_address, card_no=fields['card_no'],
+            currency=fields['currency'], amt=make_float(fields['amt']), user_mail=usermail,
+            date=self.parse_date(fields['date'], tzinfo), place=place, meta1=fields.get('meta1', None),
+            created_by=parser.get_name())
+
+        if verbose:
+            print 'Successfully parsed and saved alert: ', trans
+        return True
+
+def make_rules(spec, kind):
+    name = spec.get('name', '')
+    if not name or len(name) > MAX_NAME_LENGTH:
+        raise ValueError('Template name %r must be 1 to %d characters long.' % (name, MAX_NAME_LENGTH))
+    if not spec.get('senders', None) or not spec.get('rules', None):
+        raise ValueError('Template %s needs senders and rules.' % name)
+    rules = [TemplateRule(name, kind, rule) for rule in spec['rules']]
+    if len(set(r.name for r in rules)) != len(rules):
+        raise ValueError('Template %s has rules of the same name.' % name)
+    return rules
+
+def save_outcome(parser, outcome, uid, from_address, tzinfo, usermail):
+    "Saves the alert of a FIELDS outcome. Returns False for the other outcomes."
+    if outcome[0] != FIELDS:
+        return False
+    _, rule_name, fields = outcome
+    return parser.rules_by_name[rule_name].save(parser, fields, uid, from_address, tzinfo, usermail)
+
+def get_patterns(rules):
+    patterns = dict()
+    for rule in rules:
+        patterns.update(rule.get_patterns())
+    return patterns
+
+class TemplateMailParser(AlertMailParser):
+    "Alert mail parser defined by a bank template. The first rule whose subject matches handles the mail."
+
+    def __init__(self, spec):
+        self.name = spec.get('name', '')
+        self.rules = make_rules(spec, 'mail')
+        self.rules_by_name = dict((rule.name, rule) for rule in self.rules)
+        self.uses_html = any(rule.select is not None for rule in self.rules)
+        self.senders = list(spec['senders'])
+        self.PATTERNS = get_patterns(self.rules)
+        super(TemplateMailParser, self).__init__()
+
+    def get_from_emails_to_track(self):
+        return self.senders
+
+    def get_name(self):
+        return self.name
+
+    def is_alert_subject(self, subject):
+        return any(rule.match_subject(self, subject) for rule in self.rules)
+
+    def match(self, subject, text, html):
+        "Returns the parse outcome of the mail, see parse_cache."
+        for rule in self.rules:
+            if rule.match_subject(self, subject):
+                fields = rule.find_fields(self, text, html)
+                if fields is None:
+                    return (WARNING, rule.name)
+                return (FIELDS, rule.name, fields)
+        return (NOT_TRANSACTION,)
+
+    @db.commit_on_success
+    def parse_mail(self, from_email, to_email, date, tzinfo, subject, body, uid, usermail, text=None):
+        text = text or ''
+
+        key = parse_cache.make_key(self.get_name(), from_email, subject, body if self.uses_html else text)
+        outcome = parse_cache.get(key)
+        if outcome is None:
+            outcome = self.match(subject, text, body)
+            parse_cache.put(key, outcome)
+
+        if outcome[0] == WARNING:
+            raise ParserException(self.get_name(), 'BODY_PRASE_FAIL', 'Could not parse %s mail body.' % outcome[1])
+        if save_outcome(self, outcome, uid, from_email, tzinfo, usermail):
+            return True
+
+        if verbose:
+            print ":( No match found. There some mails with this matching from address but subject is unknown."
+        return False
+
+class TemplateSmsParser(SmsParser):
+    "Sms parser defined by a bank template. The rules are tried in order."
+
+    def __init__(self, spec):
+        self.name = spec.get('name', '')
+        self.rules = make_rules(spec, 'sms')
+        self.rules_by_name = dict((rule.name, rule) for rule in self.rules)
+        self.senders = list(spec['senders'])
+        self.PATTERNS = get_patterns(self.rules)
+        super(TemplateSmsParser, self).__init__()
+
+    def get_from_addresses_to_track(self):
+        return self.senders
+
+    def get_name(self):
+        return self.name
+
+    def get_anchors(self):
+        return [(rule.name, rule.anchor) for rule in self.rules]
+
+    def match(self, body, rules):
+        "Returns the parse outcome of the sms, see parse_cache."
+        for rule in self.rules:
+            if rules is not None and rule.name not in rules:
+                continue
+            fields = rule.find_fields(self, body)
+            if fields is not None:
+                return (FIELDS, rule.name, fields)
+        return (WARNING, None)
+
+    @db.commit_on_success
+    def parse_sms(self, from_address, body, date, tzinfo, smsid, usermail, rules=None):
+        # rules follow from the body, so they need not be part of the key.
+        key = parse_cache.make_key(self.get_name(), from_address, None, body)
+        outcome = parse_cache.get(key)
+        if outcome is None:
+            outcome = self.match(body, rules)
+            parse_cache.put(key, outcome)
+
+        if save_outcome(self, outcome, smsid, from_address, tzinfo, usermail):
+            return True
+        raise ParserWarning(self.get_name(), 'BODY_PRASE_WARN', 'Could not parse sms body.')
+
+TEMPLATE_PARSERS = {
+    'mail': TemplateMailParser,
+    'sms': TemplateSmsParser
+}
+
+def load_templates(path=TEMPLATES_PATH):
+    "Registers a parser for each bank template in the json file at path. Returns the parsers."
+    with open(path) as f:
+        specs = json.load(f)
+
+    parsers = list()
+    for spec in specs:
+        kind = spec.get('kind', None)
+        if kind not in TEMPLATE_PARSERS:
+            raise ValueError('Template %s has unknown kind %s.' % (spec.get('name', ''), kind))
+        parsers.append(TEMPLATE_PARSERS[kind](spec))
+    return parsers
+
+load_templates()
@@ -0,0 +1,66 @@
+import collections
+import imaplib
+
+from . import verbose
+
+class ImapPipeline(object):
+    """Keeps up to depth tagged commands in flight on one imaplib connection, instead of waiting
+    for each response before sending the next command.
+
+    imaplib already files every tagged response under its tag, so several can be outstanding.
+    What it cannot tell apart is the untagged data of same-named commands. Servers answer
+    pipelined commands in order (RFC 3501 5.5), so the commands are completed in the order sent
+    and each takes the untagged data read till its own tagged response.
+    """
+
+    def __init__(self, mail, depth):
+        self.mail = mail
+        self.depth = max(1, depth)
+
+    def uid(self, command, args_list):
+        """Generator of the (result, data) of UID command for each of args_list, in the same order.
+        Like imaplib.uid, but the next commands are sent before a response is read."""
+        mail = self.mail
+        command = command.upper()
+        name = command if command in ('SEARCH', 'SORT', 'THREAD') else 'FETCH'
+        if mail.state not in imaplib.Commands.get(command, ()):
+            raise mail.error('command %s illegal in state %s' % (command, mail.state))
+
+        args_list = iter(args_list)
+        in_flight = collections.deque()
+
+        def send_next():
+            args = next(args_list, None)
+            if args is not None:
+                in_flight.append(mail._command('UID', command, *args))
+
+        try:
+            for i in range(self.depth):
+                send_next()
+            if verbose: print 'Pipelined %d UID %s commands.' % (len(in_flight), command)
+
+            while in_flight:
+                tag = in_flight.popleft()
+                typ, dat = mail._command_complete('UID', tag)
+                result = mail._untagged_response(typ, dat, name)
+                send_next() # Keeps the server busy while the caller handles this response.
+                yield result
+        except mail.abort:
+            raise # The connection gets dropped anyway.
+        except:
+            # Including GeneratorExit, when the caller does not want the rest.
+            self.drain(in_flight, name)
+            raise
+
+    def drain(self, in_flight, name):
+        """Reads the responses of commands still in flight, so that they are not taken as the
+        responses of later commands."""
+        while in_flight:
+            tag = in_flight.popleft()
+            try:
+                typ, dat = self.mail._command_complete('UID', tag)
+                self.mail._untagged_response(typ, dat, name)
+            except self.mail.abort:
+                return
+            except Exception:
+                pass
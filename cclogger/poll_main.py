@@ -3,16 +3,41 @@ import traceback
 import time
 import sys
 import imaplib
+import threading
 
-from .client import MailClientManager, server_send_mail
+from .client import MailClientManager, RetryLater
 from .model import db, UserMail, TransactionAlert
-from . import SLEEP_PERIOD, admin_emails, consecutive_err_threshold
+from .common_util import Bunch
+from . import SLEEP_PERIOD, admin_emails, consecutive_err_threshold, poll_workers, info, verbose, poll_mode, \
+    use_mailbox_leases, lease_period, poller_name, min_poll_interval, max_poll_interval, poll_backoff_factor, \
+    retry_base_delay, retry_max_delay, max_retries
 from .parse import ParseCentral
+from .worker_pool import WorkerPool
+from .idle import IdleListener
+from .lease import LeaseManager
+from .scheduler import PollScheduler
+from .outbox import OutboxSender, queue_admin_alert
+from .compress import compression_stats
+from .parse_cache import parse_cache
 
 err_counts = 0
 last_err_time = 0
+err_lock = threading.Lock()
+shutdown_requested = threading.Event()
 
 client_manager = MailClientManager()
+poll_pool = None
+
+idle_listener = None
+idle_unsupported = set() # Ids of mailboxes whose servers do not support IDLE. These are always polled.
+pushed_lock = threading.Lock()
+pushed_in_flight = set() # Ids of mailboxes being processed due to IDLE push.
+pushed_again = set() # Ids of mailboxes which got another push while being processed.
+
+lease_manager = LeaseManager(lease_period, poller_name) if use_mailbox_leases else None
+poll_scheduler = PollScheduler(min_poll_interval, max_poll_interval, poll_backoff_factor,
+    retry_base_delay, retry_max_delay, max_retries)
+outbox_sender = OutboxSender(poller_name)
 
 def now():
     return long(round(time.time() * 1000))
@@ -20,76 +45,272 @@ def now():
 def incr_err():
     global err_counts, last_err_time
 
-    curr = now()
-    if err_counts == 0 or (curr - last_err_time) < 10000:
-        err_counts += 1
-        last_err_time = curr
-    else:
-        err_counts = 0
+    with err_lock:
+        curr = now()
+        if err_counts == 0 or (curr - last_err_time) < 10000:
+            err_counts += 1
+            last_err_time = curr
+        else:
+            err_counts = 0
 
-    return err_counts
+        return err_counts
 
-def process_new():
+def get_poll_pool():
+    global poll_pool
+    if poll_pool is None:
+        poll_pool = WorkerPool(poll_workers, name='poller')
+    return poll_pool
+
+def process_usermail(usermail):
+    """Checks one mailbox for new alerts. Runs on a poller worker thread.
+    Returns False if the error threshold is reached and the poller must shut down."""
+    if shutdown_requested.is_set():
+        return False
+    outcome = Bunch(found_new=False, retrying=False)
     try:
-        db.connect()
-        for usermail in UserMail.select().where(UserMail.is_dummy == False, UserMail.is_bad == False, UserMail.is_sms == False):
-            try:
-                client = client_manager.get_mail_client_from_pool(usermail)
+        return poll_usermail(usermail, outcome)
+    except Exception, e:
+        # Errors poll_usermail does not handle itself, like the DB failing while saving the uid mark.
+        if not db.is_closed():
+            db.close() # Reconnects on next use.
+        return report_poll_exception(e, traceback.format_exc())
+    finally:
+        # Always, since pop_due took the mailbox off the schedule and nothing else puts it back.
+        if not outcome.retrying:
+            poll_scheduler.done(usermail, outcome.found_new)
 
-                uids = client.get_new_mail_uids()
-                try:
-                    uids = sorted(uids, key=int)
-                except ValueError:
-                    # I couldn't find any RFC doc specifying that UID must be number. Hence, taking no chance.
-                    uids = sorted(uids)
-
-                for uid in uids:
-                    mark_read = False
-                    if not TransactionAlert.select().where(TransactionAlert.uid == uid, \
-                        TransactionAlert.user_mail == usermail).exists():
-
-                        mail = client.fetch_mail(uid)
-                        mark_read = ParseCentral.getInstance().parse(mail, uid, usermail)
-
-                    if mark_read:
-                        if not client.mark_mail_as_read(uid):
-                            print "Could not mark mail as read."
-                            if admin_emails:
-                                server_send_mail(admin_emails,
-                                    "CCTracker Error", "Could not mark mail as read.")
-            except (imaplib.IMAP4_SSL.error, imaplib.IMAP4.error) as e:
-                usermail.is_bad = True
-                usermail.error = str(e)
-                usermail.save()
-            except Exception, e:
-                print '>>> Exception: ', str(e)
-                stk = traceback.format_exc()
-                print stk
-                print "Reporting exception to owner email", admin_emails
-                if admin_emails:
-                    server_send_mail(admin_emails, "CCTracker Exception: %s" % str(e), "<pre>\n%s</pre>" % stk)
-                if incr_err() >= consecutive_err_threshold: #Turn off when there are consecutive_err_threshold consecutive errors.
-                    print "Reached max error threshold. Shutting down."
-                    return False
+def poll_usermail(usermail, outcome):
+    """Does the work of process_usermail. Sets outcome.found_new, and outcome.retrying when the poll is to
+    be retried after a backoff instead of on the usermail's regular schedule."""
+    if lease_manager and not lease_manager.holds(usermail):
+        if info: print 'Lease of %s lapsed during the poll cycle. Skipping it.' % usermail.email
+        return True
+
+    client = None
+    last_uid = None
+    resynced = False
+    try:
+        client = client_manager.get_mail_client_from_pool(usermail)
+
+        senders = ParseCentral.getInstance().get_tracked_from_emails()
+        is_incremental = client.uid_validity is not None and client.uid_validity == usermail.uid_validity
+        if is_incremental:
+            uids = client.get_new_mail_uids(since_uid=usermail.last_uid + 1, from_emails=senders)
+        else:
+            # First poll or the uids were reset by the server. Old high-water mark means nothing now.
+            if verbose: print 'Full resync of %s. UIDVALIDITY %s => %s' % (usermail.email,
+                usermail.uid_validity, client.uid_validity)
+            uids = client.get_new_mail_uids(from_emails=senders)
+        # RFC 3501 defines uids as 32 bit numbers, which the high-water mark relies on.
+        uids = sorted(uids, key=long)
+        outcome.found_new = len(uids) > 0
 
+        saved = get_saved_alert_uids(usermail, uids)
+        # Bodies are downloaded only for the mails whose sender and subject some parser accepts.
+        central = ParseCentral.getInstance()
+        candidates = [uid for uid, from_email, subject in client.fetch_envelopes([uid for uid in uids if uid not in saved])
+            if central.is_candidate(from_email, subject)]
+        candidates = sorted(candidates, key=long)
+        to_mark_read = []
+        try:
+            for uid, mail in client.fetch_mails(candidates):
+                if mail is not None: # None when the mail got deleted after the search.
+                    if central.parse(mail, uid, usermail):
+                        to_mark_read.append(uid)
+                if is_incremental:
+                    last_uid = long(uid)
+        finally:
+            # Parsed ones are flagged together, even when a later mail failed.
+            mark_parsed_as_read(client, usermail, to_mark_read)
+
+        if is_incremental:
+            if uids:
+                last_uid = long(uids[-1])
+        else:
+            # Mark is moved only after the whole resync succeeds, else the next poll resyncs again.
+            usermail.uid_validity = client.uid_validity
+            usermail.last_uid = max([client.uid_next - 1 if client.uid_next else 0] + [long(uid) for uid in uids])
+            resynced = True
+    except RetryLater, e:
+        # Connection broke. Instead of blocking this worker, the poll is retried later by the scheduler.
+        delay = poll_scheduler.retry_later(usermail)
+        if delay is None:
+            return report_poll_exception(e.cause, traceback.format_exc())
+        outcome.retrying = True
+        if not poll_scheduler.is_scheduled(usermail): # Polled due to IDLE push.
+            t = threading.Timer(delay, push_poll, [usermail])
+            t.daemon = True
+            t.start()
+    except (imaplib.IMAP4_SSL.error, imaplib.IMAP4.error) as e:
+        usermail.is_bad = True
+        usermail.error = str(e)
+        # Not save(), which would write back the lease and uid mark loaded earlier, maybe over newer ones.
+        UserMail.update(is_bad=usermail.is_bad, error=usermail.error).where(UserMail.id == usermail.id).execute()
+    except Exception, e:
+        if not db.is_closed():
+            db.close() # In case the DB connection broke. Reconnects on next use.
+        return report_poll_exception(e, traceback.format_exc())
     finally:
-        db.close()
+        if client:
+            client_manager.return_client_to_pool(client)
+        save_uid_mark(usermail, last_uid, resynced)
+    return True
+
+def mark_parsed_as_read(client, usermail, uids):
+    """Flags uids as seen. If the connection broke midway, reconnects once to do so, since the uid mark moves
+    past them and they would never be flagged otherwise."""
+    if not uids:
+        return
+    try:
+        if not client.mail:
+            client.open_connection(non_retryable=True)
+        failed = client.mark_mails_as_read(uids)
+    except Exception, e:
+        if verbose: print 'Could not reconnect to mark mails as read.', e
+        failed = uids
+    if failed:
+        print "Could not mark mails as read.", failed
+        queue_admin_alert("CCTracker Error",
+            "Could not mark mails of %s with uids %s as read." % (usermail.email, ', '.join(failed)))
+
+def report_poll_exception(e, stk):
+    """Mails the exception to the admins. Returns False when the error threshold is reached."""
+    print '>>> Exception: ', str(e)
+    print stk
+    print "Reporting exception to owner email", admin_emails
+    queue_admin_alert("CCTracker Exception: %s" % str(e), "<pre>\n%s</pre>" % stk)
+    if incr_err() >= consecutive_err_threshold: #Turn off when there are consecutive_err_threshold consecutive errors.
+        print "Reached max error threshold. Shutting down."
+        shutdown_requested.set()
+        return False
     return True
 
+def get_saved_alert_uids(usermail, uids):
+    """Uids among uids which were already parsed and saved as alerts, e.g. before a crash."""
+    if not uids:
+        return set()
+    q = TransactionAlert.select(TransactionAlert.uid).where((TransactionAlert.user_mail == usermail)
+        & (TransactionAlert.uid << uids))
+    return set(t.uid for t in q)
+
+def save_uid_mark(usermail, last_uid, resynced):
+    """Advances the uid high-water mark of usermail to last_uid. Saved even when the poll failed midway,
+    so that the mails processed before the failure are not fetched again."""
+    if last_uid is not None and last_uid > usermail.last_uid:
+        usermail.last_uid = last_uid
+    elif not resynced:
+        return
+    usermail.save(only=[UserMail.last_uid, UserMail.uid_validity])
+
+def poll_and_watch(usermail):
+    """Polls usermail and then, in idle mode, hands it over to the IDLE listener when its server supports it."""
+    if not process_usermail(usermail):
+        return False
+
+    if idle_listener and usermail.id not in idle_unsupported and not usermail.is_bad:
+        try:
+            if not idle_listener.watch(usermail, usermail.last_uid):
+                if info: print 'IDLE not supported for %s. It will be polled.' % usermail.email
+                idle_unsupported.add(usermail.id)
+        except Exception, e:
+            print '>>> Could not start IDLE for %s. It will be polled. Error: %s' % (usermail.email, e)
+    return True
+
+def push_poll(usermail):
+    """Called by the IDLE listener when usermail reports new mail."""
+    with pushed_lock:
+        if usermail.id in pushed_in_flight:
+            pushed_again.add(usermail.id)
+            return
+        pushed_in_flight.add(usermail.id)
+    get_poll_pool().submit(process_pushed, usermail)
+
+def process_pushed(usermail):
+    while True:
+        process_usermail(usermail)
+        with pushed_lock:
+            if usermail.id not in pushed_again:
+                pushed_in_flight.discard(usermail.id)
+                return
+            pushed_again.discard(usermail.id)
+
+def start_idle_listener():
+    global idle_listener
+    idle_listener = IdleListener(push_poll)
+    idle_listener.start()
+
+def process_new():
+    start = time.time()
+    try:
+        db.connect()
+        if lease_manager:
+            usermails = lease_manager.claim()
+        else:
+            usermails = list(UserMail.select_pollable())
+    finally:
+        db.close()
+
+    if idle_listener:
+        idle_listener.retain(set(u.id for u in usermails))
+        usermails = [u for u in usermails if not idle_listener.is_watching(u)]
+
+    poll_scheduler.sync(usermails)
+    due = poll_scheduler.pop_due()
+    results = get_poll_pool().map(poll_and_watch, due)
+
+    if info:
+        print 'Poll cycle checked %d of %d mailboxes in %.3f secs.' % (len(due), len(usermails), time.time() - start)
+        print 'Connection pool: %(hits)d hits, %(misses)d misses (hit rate %(hit_rate).2f), %(evictions)d evictions, ' \
+            '%(idle)d idle, %(in_use)d in use.' % client_manager.get_stats()
+        print 'IMAP compression: %(wire_in)d bytes received for %(plain_in)d (ratio %(ratio_in).2f).' % \
+            compression_stats.get_stats()
+        print 'Parse cache: %(hits)d hits, %(misses)d misses (hit rate %(hit_rate).2f), %(evictions)d evictions, ' \
+            '%(size)d outcomes.' % parse_cache.get_stats()
+    return not shutdown_requested.is_set() and all(r is not False for r in results)
+
+def seconds_till_next_cycle():
+    """Sleeps till the next mailbox falls due, but at most SLEEP_PERIOD, so that new mailboxes are picked up."""
+    wait = poll_scheduler.seconds_till_next_due()
+    if wait is None:
+        return SLEEP_PERIOD
+    return min(wait, SLEEP_PERIOD)
+
 
 def main_run(): 
+    outbox_sender.start()
+    if poll_mode == 'idle':
+        start_idle_listener()
+
+    try:
+        run_poll_loop()
+    finally:
+        try:
+            outbox_sender.drain(flush=True) # Last alerts are not held back for the digest.
+        except Exception, e:
+            print '>>> Could not send the queued mails: ', str(e)
+        client_manager.close_idle() # Logs out of the pooled connections instead of dropping them.
+        if lease_manager:
+            try:
+                db.connect()
+                try:
+                    lease_manager.shutdown()
+                finally:
+                    db.close()
+            except Exception, e:
+                print '>>> Could not release the mailbox leases: ', str(e)
+
+def run_poll_loop():
     while(True):   
         try:
             if not process_new():
                 return
-            time.sleep(SLEEP_PERIOD) 
+            time.sleep(seconds_till_next_cycle())
         except Exception, e:
             print '>>> Exception: ', str(e)
             stk = traceback.format_exc()
             print stk
             print "Reporting exception to owner email", admin_emails
-            if admin_emails:
-                server_send_mail(admin_emails, "CCTracker Exception: %s" % str(e), "<pre>\n%s</pre>" % stk)
+            queue_admin_alert("CCTracker Exception: %s" % str(e), "<pre>\n%s</pre>" % stk)
             if incr_err() >= consecutive_err_threshold: #Turn off when there are consecutive_err_threshold consecutive errors.
                 print "Reached max error threshold. Shutting down."
                 return
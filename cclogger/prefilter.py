@@ -0,0 +1,58 @@
+import collections
+
+class AnchorIndex(object):
+    """Aho-Corasick automaton over lower cased anchor phrases. find() reports every anchor occurring in a text,
+    overlapping ones included, in one pass over the text however many anchors there are."""
+
+    def __init__(self):
+        self.anchors = dict() # anchor -> list of values
+        self.automaton = None
+
+    def add(self, anchor, value):
+        self.anchors.setdefault(anchor.lower(), list()).append(value)
+        self.automaton = None
+
+    def build(self):
+        goto = [dict()]
+        out = [list()]
+        for anchor, values in self.anchors.items():
+            state = 0
+            for c in anchor:
+                next_state = goto[state].get(c, None)
+                if next_state is None:
+                    next_state = len(goto)
+                    goto.append(dict())
+                    out.append(list())
+                    goto[state][c] = next_state
+                state = next_state
+            out[state].extend(values)
+
+        # Breadth first, so that the fail state of each state is set before its children's.
+        fail = [0] * len(goto)
+        queue = collections.deque(goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for c, child in goto[state].items():
+                queue.append(child)
+                f = fail[state]
+                while f and c not in goto[f]:
+                    f = fail[f]
+                fail[child] = goto[f].get(c, 0)
+                out[child] = out[child] + out[fail[child]]
+        self.automaton = (goto, fail, out)
+
+    def find(self, text):
+        "Returns the set of values of the anchors in text."
+        if self.automaton is None:
+            self.build()
+        goto, fail, out = self.automaton
+
+        found = set()
+        state = 0
+        for c in text.lower():
+            while state and c not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(c, 0)
+            if out[state]:
+                found.update(out[state])
+        return found
@@ -0,0 +1,117 @@
+import heapq
+import random
+import threading
+import time
+
+from . import verbose
+
+class PollScheduler(object):
+    """Priority queue of mail boxes keyed by the time they are next due for polling.
+
+    Each mail box has its own interval between min_interval and max_interval. It is multiplied by
+    backoff_factor every time a poll finds nothing new and divided by it when a poll finds new
+    mails. So quiet mail boxes are polled rarely and busy ones often.
+    """
+
+    def __init__(self, min_interval, max_interval, backoff_factor, retry_base_delay=3, retry_max_delay=60, max_retries=5):
+        self.min_interval = float(min_interval)
+        self.max_interval = float(max(min_interval, max_interval))
+        self.backoff_factor = max(1.0, float(backoff_factor))
+        self.retry_base_delay = float(retry_base_delay)
+        self.retry_max_delay = float(max(retry_base_delay, retry_max_delay))
+        self.max_retries = max_retries
+        self.retry_attempts = dict() # usermail id -> retries done since its last successful poll
+        self.heap = [] # (due time, seq, usermail id). Entries whose seq is stale are skipped.
+        self.entries = dict() # usermail id -> Entry
+        self.seq = 0
+        self.lock = threading.Lock()
+
+    class Entry(object):
+        def __init__(self, usermail, interval):
+            self.usermail = usermail
+            self.interval = interval
+            self.due = 0
+            self.seq = None # None while the mail box is being polled.
+
+    def _push(self, entry, due):
+        self.seq += 1
+        entry.due = due
+        entry.seq = self.seq
+        heapq.heappush(self.heap, (due, self.seq, entry.usermail.id))
+
+    def sync(self, usermails):
+        """Makes the schedule hold exactly usermails. New ones are spread over the next min interval,
+        so that they do not all fall due together."""
+        now = time.time()
+        with self.lock:
+            ids = set()
+            for usermail in usermails:
+                ids.add(usermail.id)
+                entry = self.entries.get(usermail.id, None)
+                if entry:
+                    entry.usermail = usermail # Picks up changes like a new password.
+                else:
+                    entry = self.Entry(usermail, self.min_interval)
+                    self.entries[usermail.id] = entry
+                    self._push(entry, now + random.uniform(0, self.min_interval))
+            for usermail_id in [i for i in self.entries if i not in ids]:
+                del self.entries[usermail_id] # Its heap entry is skipped when popped.
+
+    def pop_due(self, now=None):
+        """Removes and returns the mail boxes which are due. Each must be handed back using done()."""
+        now = now or time.time()
+        due = []
+        with self.lock:
+            while self.heap and self.heap[0][0] <= now:
+                _, seq, usermail_id = heapq.heappop(self.heap)
+                entry = self.entries.get(usermail_id, None)
+                if entry and entry.seq == seq:
+                    entry.seq = None
+                    due.append(entry.usermail)
+        return due
+
+    def done(self, usermail, found_new):
+        """Schedules the next poll of usermail based on whether this poll found new mails."""
+        with self.lock:
+            self.retry_attempts.pop(usermail.id, None)
+            entry = self.entries.get(usermail.id, None)
+            if not entry or entry.seq is not None:
+                return # Not scheduled, e.g. polled due to IDLE push.
+            if found_new:
+                entry.interval = max(self.min_interval, entry.interval / self.backoff_factor)
+            else:
+                entry.interval = min(self.max_interval, entry.interval * self.backoff_factor)
+            self._push(entry, time.time() + entry.interval)
+            if verbose: print 'Next poll of %s in %.1f secs.' % (usermail.email, entry.interval)
+
+    def retry_later(self, usermail):
+        """Schedules a retry of usermail's failed poll after an exponential backoff with jitter, in
+        place of its regular next poll. Returns the delay, or None once max_retries are used up."""
+        with self.lock:
+            attempt = self.retry_attempts.get(usermail.id, 0)
+            if attempt >= self.max_retries:
+                del self.retry_attempts[usermail.id]
+                return None
+            self.retry_attempts[usermail.id] = attempt + 1
+
+            backoff = min(self.retry_max_delay, self.retry_base_delay * (2 ** attempt))
+            delay = backoff / 2 + random.uniform(0, backoff / 2) # Jitter keeps retries to one host apart.
+            entry = self.entries.get(usermail.id, None)
+            if entry and entry.seq is None:
+                self._push(entry, time.time() + delay)
+            if verbose: print 'Retry %d of %s in %.1f secs.' % (attempt + 1, usermail.email, delay)
+            return delay
+
+    def is_scheduled(self, usermail):
+        with self.lock:
+            return usermail.id in self.entries
+
+    def seconds_till_next_due(self):
+        with self.lock:
+            while self.heap:
+                due, seq, usermail_id = self.heap[0]
+                entry = self.entries.get(usermail_id, None)
+                if entry and entry.seq == seq:
+                    return max(0, due - time.time())
+                heapq.heappop(self.heap) # Stale.
+        return None
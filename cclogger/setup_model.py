@@ -1,7 +1,7 @@
 from .model import InMailServerConfig, OutMailServerConfig, User, UserMail, UserMailMap, TransactionAlert, \
-	Place, SmsPref
+	Place, SmsPref, Poller, OutboxMail
 
-recreate = True
+recreate = True # Drops all the data. Upgrade existing installs with migrate_model instead.
 if recreate:
 	TransactionAlert.drop_table(fail_silently=True)
 	Place.drop_table(fail_silently=True)
@@ -11,6 +11,8 @@ if recreate:
 	User.drop_table(fail_silently=True)
 	OutMailServerConfig.drop_table(fail_silently=True)
 	InMailServerConfig.drop_table(fail_silently=True)
+	Poller.drop_table(fail_silently=True)
+	OutboxMail.drop_table(fail_silently=True)
 
 InMailServerConfig.create_table(fail_silently=True)
 OutMailServerConfig.create_table(fail_silently=True)
@@ -20,6 +22,8 @@ UserMail.create_table(fail_silently=True)
 UserMailMap.create_table(fail_silently=True)
 Place.create_table(fail_silently=True)
 TransactionAlert.create_table(fail_silently=True)
+Poller.create_table(fail_silently=True)
+OutboxMail.create_table(fail_silently=True)
 
 d = InMailServerConfig.get_or_create(at_domain="-sms-")
 d.hostname = "-"
@@ -41,6 +45,7 @@ d = InMailServerConfig.get_or_create(at_domain="gmail.com")
 d.hostname = "imap.gmail.com"
 d.port=993
 d.use_ssl=True
+d.use_compress=True
 d.save()
 
 d = OutMailServerConfig.get_or_create(at_domain="gmail.com")
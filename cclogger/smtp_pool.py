@@ -0,0 +1,105 @@
+import smtplib
+import socket
+import threading
+import time
+
+from . import verbose, timeout
+
+class SmtpConnectionPool(object):
+    """Logged in SMTP sessions keyed by (host, port, user), reused across sends.
+
+    Sessions unused for idle_timeout secs are closed, since servers drop them anyway. A send on a
+    reused session which the server has meanwhile closed is retried once on a new session.
+    """
+
+    def __init__(self, idle_timeout=60, max_idle_per_key=2):
+        self.idle_timeout = idle_timeout
+        self.max_idle_per_key = max_idle_per_key
+        self.idle = dict() # (host, port, user) -> [(smtp, time returned)]. Most recent last.
+        self.lock = threading.Lock()
+        self.connects = 0
+        self.reuses = 0
+
+    def _connect(self, out_mail_config, username, password):
+        if verbose:
+            print 'Opening SMTP session', out_mail_config.hostname, out_mail_config.port, out_mail_config.use_ssl
+        if out_mail_config.use_ssl:
+            s = smtplib.SMTP_SSL(out_mail_config.hostname, out_mail_config.port, timeout=timeout)
+        else:
+            s = smtplib.SMTP(out_mail_config.hostname, out_mail_config.port, timeout=timeout)
+        try:
+            s.login(username, password)
+        except:
+            self._close(s)
+            raise
+        with self.lock:
+            self.connects += 1
+        return s
+
+    def _close(self, s):
+        try:
+            s.quit()
+        except Exception:
+            try:
+                s.close()
+            except Exception:
+                pass
+
+    def _checkout(self, key):
+        s = None
+        with self.lock:
+            deadline = time.time() - self.idle_timeout
+            sessions = self.idle.pop(key, [])
+            expired = [c for c, returned_at in sessions if returned_at <= deadline]
+            fresh = [(c, returned_at) for c, returned_at in sessions if returned_at > deadline]
+            if fresh:
+                s = fresh.pop()[0]
+                self.reuses += 1
+            if fresh:
+                self.idle[key] = fresh
+        for c in expired:
+            self._close(c)
+        return s
+
+    def _checkin(self, key, s):
+        extra = None
+        with self.lock:
+            sessions = self.idle.setdefault(key, [])
+            sessions.append((s, time.time()))
+            if len(sessions) > self.max_idle_per_key:
+                extra = sessions.pop(0)[0]
+        if extra:
+            self._close(extra)
+
+    def sendmail(self, out_mail_config, username, password, from_email, to, msg):
+        key = (out_mail_config.hostname, out_mail_config.port, username)
+        s = self._checkout(key)
+        if s is not None:
+            try:
+                s.sendmail(from_email, to, msg)
+                self._checkin(key, s)
+                return
+            except (smtplib.SMTPServerDisconnected, smtplib.SMTPSenderRefused, socket.error), e:
+                # SMTPSenderRefused is what some servers answer on a session they consider timed out.
+                if verbose: print 'Reused SMTP session failed. Reconnecting.', e
+                self._close(s)
+            except:
+                # E.g. the recipients were refused. Retrying would not help, and the session is in an unknown state.
+                self._close(s)
+                raise
+
+        s = self._connect(out_mail_config, username, password)
+        try:
+            s.sendmail(from_email, to, msg)
+        except:
+            self._close(s)
+            raise
+        self._checkin(key, s)
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                'connects': self.connects,
+                'reuses': self.reuses,
+                'idle': sum(len(v) for v in self.idle.values())
+            }
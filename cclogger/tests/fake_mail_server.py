@@ -0,0 +1,566 @@
+import Queue
+import random
+import re
+import select
+import socket
+import ssl
+import threading
+import time
+import zlib
+
+CITI_FROM = 'CitiAlert.India@citicorp.com'
+CITI_SUBJECT = 'Transaction confirmation on your Citibank credit card'
+HDFC_FROM = 'alerts@hdfcbank.net'
+NOISE_FROMS = ['newsletter@shop.example.com', 'friend@example.org', 'noreply@social.example.net']
+SHOPS = ['AMAZON SELLER SERVICES', 'CAFE COFFEE DAY', 'BIG BAZAAR', 'SHELL PETROL PUMP', 'BOOK MY SHOW']
+MONTHS = ['JAN', 'FEB', 'MAR', 'APR', 'MAY', 'JUN', 'JUL', 'AUG', 'SEP', 'OCT', 'NOV', 'DEC']
+
+IMAP_TOKEN_RE = re.compile(r'"((?:[^"\\]|\\.)*)"|(\()|(\))|([^\s()"]+(?:\[[^\]]*\])?(?:<[\d.]+>)?)')
+
+class FakeMail(object):
+    def __init__(self, uid, from_email, subject, body, content_type='text/html'):
+        self.uid = uid
+        self.from_email = from_email
+        self.subject = subject
+        self.seen = False
+        self.raw = ('From: <%s>\r\nTo: <user@loadtest.invalid>\r\nSubject: %s\r\n'
+            'Date: %s\r\nMIME-Version: 1.0\r\nContent-Type: %s; charset=us-ascii\r\n\r\n%s\r\n') % (
+            from_email, subject, time.strftime('%a, %d %b %Y %H:%M:%S +0530'), content_type, body)
+
+    def get_header_fields(self):
+        return 'From: <%s>\r\nSubject: %s\r\n\r\n' % (self.from_email, self.subject)
+
+def make_citi_alert(uid):
+    amt = '%d.%02d' % (random.randint(10, 50000), random.randint(0, 99))
+    date = '%02d-%s-%02d' % (random.randint(1, 28), random.choice(MONTHS), random.randint(15, 25))
+    body = ('<html><body><table><tr><td>Dear Cardmember,</td></tr><tr><td>INR %s was spent on your Credit Card '
+        '4111XXXXXXXX%04d on %s at %s. </td></tr><tr><td>Reference No: LT%08d</td></tr></table>'
+        '<p>This is a system generated mail.</p></body></html>') % (amt, random.randint(0, 9999), date,
+        random.choice(SHOPS), uid)
+    return FakeMail(uid, CITI_FROM, CITI_SUBJECT, body)
+
+def make_hdfc_alert(uid):
+    body = 'Thank you for using your HDFC bank CREDIT card ending %04d for INR %d.00 in MUMBAI. at %s. , on %s.' % (
+        random.randint(0, 9999), random.randint(10, 9999), random.choice(SHOPS), time.strftime('%Y-%m-%d'))
+    return FakeMail(uid, HDFC_FROM, 'Transaction alert', body, 'text/plain')
+
+def make_noise(uid):
+    if random.random() < 0.3:
+        # Tracked sender, but not an alert subject. Must be dropped after fetching just the envelope.
+        return FakeMail(uid, CITI_FROM, 'Your Citibank statement is ready', '<p>%s</p>' % ('x' * 2000))
+    return FakeMail(uid, random.choice(NOISE_FROMS), 'Offers for you', '<p>%s</p>' % ('Lorem ipsum. ' * 300))
+
+# Share of each kind of mail. HDFC sends its alerts as SMS, which no mail parser tracks, so its mails
+# are noise to the poller.
+MESSAGE_MIX = [(make_citi_alert, 0.4), (make_hdfc_alert, 0.2), (make_noise, 0.4)]
+MESSAGE_MAKERS = {'citi': make_citi_alert, 'hdfc': make_hdfc_alert, 'noise': make_noise}
+
+def parse_mix(spec):
+    """Parses a message mix like citi=0.4,hdfc=0.2,noise=0.4 into a list like MESSAGE_MIX. The shares are
+    scaled to add up to 1."""
+    mix = []
+    for part in spec.split(','):
+        name, _, share = part.partition('=')
+        maker = MESSAGE_MAKERS.get(name.strip().lower(), None)
+        if maker is None:
+            raise ValueError('Unknown kind of mail %r in mix. Known ones are %s.' % (name,
+                ', '.join(sorted(MESSAGE_MAKERS))))
+        mix.append((maker, float(share)))
+    total = sum(share for _, share in mix)
+    if total <= 0 or any(share < 0 for _, share in mix):
+        raise ValueError('Mix %s must have positive shares.' % spec)
+    return [(maker, share / total) for maker, share in mix]
+
+class FakeMailbox(object):
+    def __init__(self, email, password, mix=None):
+        self.email = email
+        self.password = password
+        self.mix = mix or MESSAGE_MIX
+        self.uid_validity = random.randint(1, 1 << 30)
+        self.mails = []
+        self.next_uid = 1
+        self.idlers = set() # Sessions in IDLE on this mailbox.
+        self.lock = threading.Lock()
+
+    def add_mail(self, maker=None):
+        with self.lock:
+            if maker is None:
+                r = random.random()
+                for maker, share in self.mix:
+                    r -= share
+                    if r < 0:
+                        break
+            self.mails.append(maker(self.next_uid))
+            self.next_uid += 1
+            exists = len(self.mails)
+            idlers = list(self.idlers)
+        for session in idlers:
+            session.push('* %d EXISTS\r\n' % exists)
+
+class ServerStats(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.commands = 0
+        self.round_trips = 0 # Commands that arrived when no earlier one was awaiting its response.
+        self.dropped = 0
+        self.fetched_bytes = 0
+        self.compressed_sessions = 0
+        self.idle_pushes = 0
+        self.per_mailbox = dict() # email -> [commands, round trips]
+
+    def add_command(self, mailbox, is_round_trip):
+        with self.lock:
+            self.commands += 1
+            self.round_trips += 1 if is_round_trip else 0
+            if mailbox:
+                counts = self.per_mailbox.setdefault(mailbox.email, [0, 0])
+                counts[0] += 1
+                counts[1] += 1 if is_round_trip else 0
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                'connections': self.connections,
+                'commands': self.commands,
+                'round_trips': self.round_trips,
+                'dropped': self.dropped,
+                'fetched_bytes': self.fetched_bytes,
+                'compressed_sessions': self.compressed_sessions,
+                'idle_pushes': self.idle_pushes,
+                'mailbox_round_trips': sum(c[1] for c in self.per_mailbox.values())
+            }
+
+class Dropped(Exception):
+    pass
+
+class InflatingReader(object):
+    """Reads the lines of a COMPRESS=DEFLATE stream from a socket."""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.decompressor = zlib.decompressobj(-15)
+        self.buf = ''
+
+    def readline(self):
+        while '\n' not in self.buf:
+            data = self.sock.recv(16384)
+            if not data:
+                line, self.buf = self.buf, ''
+                return line
+            self.buf += self.decompressor.decompress(data)
+        line, self.buf = self.buf.split('\n', 1)
+        return line + '\n'
+
+def serve_tls(conn, certfile):
+    """Terminates TLS on conn in a thread of its own. Returns the socket to serve the plain protocol on."""
+    plain, inner = socket.socketpair()
+    t = threading.Thread(target=relay_tls, args=(conn, inner, certfile))
+    t.daemon = True
+    t.start()
+    return plain
+
+def relay_tls(conn, plain, certfile):
+    """Copies between the TLS connection conn and the socket plain. Only this thread uses the SSL
+    object, since OpenSSL does not allow reading and writing one from two threads at once."""
+    tls = None
+    try:
+        tls = ssl.wrap_socket(conn, server_side=True, certfile=certfile)
+        poller = select.poll()
+        poller.register(tls, select.POLLIN)
+        poller.register(plain, select.POLLIN)
+        while True:
+            # Decrypted bytes buffered inside the SSL object are not visible to poll().
+            ready = [tls.fileno()] if tls.pending() else [fd for fd, _ in poller.poll()]
+            for fd in ready:
+                src, dest = (tls, plain) if fd == tls.fileno() else (plain, tls)
+                data = src.recv(16384)
+                if not data:
+                    return
+                dest.sendall(data)
+    except (ssl.SSLError, socket.error, select.error):
+        pass
+    finally:
+        for sock in (tls or conn, plain):
+            try:
+                sock.close()
+            except socket.error:
+                pass
+
+class FakeImapSession(object):
+    def __init__(self, server, conn):
+        self.server = server
+        self.conn = conn
+        self.mailbox = None
+        self.selected = False
+        self.out = Queue.Queue() # (due time, data, is response, compress after)
+        self.awaiting = 0 # Commands whose response is not yet sent.
+        self.lock = threading.Lock()
+        self.reader = conn.makefile('rb')
+        self.compressor = None # Used by the writer thread once COMPRESS succeeded.
+        self.compressed = False
+        self.start_compress = False
+        self.idle_tag = None
+
+    def reply(self, data, arrived, compress_after=False):
+        with self.lock:
+            self.awaiting += 1
+        self.out.put((arrived + self.server.latency, data, True, compress_after))
+
+    def push(self, data):
+        """Sends untagged data not in response to a command, e.g. EXISTS during IDLE."""
+        with self.server.stats.lock:
+            self.server.stats.idle_pushes += 1
+        self.out.put((time.time(), data, False, False))
+
+    def write_loop(self):
+        while True:
+            due, data, is_response, compress_after = self.out.get()
+            if data is None:
+                return
+            wait = due - time.time()
+            if wait > 0:
+                time.sleep(wait)
+            try:
+                if self.compressor:
+                    data = self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+                self.conn.sendall(data)
+                if compress_after:
+                    self.compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+            except socket.error:
+                return
+            finally:
+                if is_response:
+                    with self.lock:
+                        self.awaiting -= 1
+
+    def run(self):
+        writer = threading.Thread(target=self.write_loop)
+        writer.daemon = True
+        writer.start()
+        self.reply('* OK Fake IMAP4rev1 ready\r\n', time.time())
+        try:
+            while True:
+                line = self.reader.readline()
+                if not line:
+                    break
+                arrived = time.time()
+                with self.lock:
+                    is_round_trip = self.awaiting == 0
+                self.server.stats.add_command(self.mailbox, is_round_trip)
+                if random.random() < self.server.drop_rate:
+                    raise Dropped()
+                if self.idle_tag is not None:
+                    response = self.end_idle(line.strip())
+                else:
+                    response = self.handle(line.rstrip('\r\n'))
+                self.reply(response, arrived, self.start_compress)
+                if self.start_compress:
+                    # The client sends compressed data only after the OK, so nothing more is buffered.
+                    self.start_compress = False
+                    self.reader = InflatingReader(self.conn)
+                if response.startswith('* BYE'):
+                    break
+        except (Dropped, socket.error):
+            with self.server.stats.lock:
+                self.server.stats.dropped += 1
+        finally:
+            if self.mailbox:
+                with self.mailbox.lock:
+                    self.mailbox.idlers.discard(self)
+            self.out.put((0, None, False, False))
+            writer.join()
+            try:
+                self.conn.close()
+            except socket.error:
+                pass
+
+    def handle(self, line):
+        tokens = [m.group(1) if m.group(1) is not None else m.group(0) for m in IMAP_TOKEN_RE.finditer(line)]
+        if len(tokens) < 2:
+            return '* BAD Empty command\r\n'
+        tag, command, args = tokens[0], tokens[1].upper(), tokens[2:]
+        try:
+            if command == 'UID' and args:
+                return self.handle_uid(tag, args[0].upper(), args[1:])
+            handler = getattr(self, 'cmd_' + command.lower(), None)
+            if handler is None:
+                return '%s BAD Unknown command\r\n' % tag
+            return handler(tag, args)
+        except (IndexError, ValueError), e:
+            return '%s BAD %s\r\n' % (tag, e)
+
+    def cmd_capability(self, tag, args):
+        capabilities = ['IMAP4rev1']
+        if self.server.idle:
+            capabilities.append('IDLE')
+        if self.server.compress and not self.compressed:
+            capabilities.append('COMPRESS=DEFLATE')
+        return '* CAPABILITY %s\r\n%s OK CAPABILITY completed\r\n' % (' '.join(capabilities), tag)
+
+    def cmd_compress(self, tag, args):
+        if not self.server.compress or [a.upper() for a in args] != ['DEFLATE']:
+            return '%s BAD Unsupported compression\r\n' % tag
+        if self.compressed:
+            return '%s NO [COMPRESSIONACTIVE] Compression already active\r\n' % tag
+        self.compressed = self.start_compress = True
+        with self.server.stats.lock:
+            self.server.stats.compressed_sessions += 1
+        return '%s OK DEFLATE active\r\n' % tag
+
+    def cmd_idle(self, tag, args):
+        if not self.server.idle:
+            return '%s BAD Unknown command\r\n' % tag
+        if not self.selected:
+            return '%s BAD No mailbox selected\r\n' % tag
+        self.idle_tag = tag
+        with self.mailbox.lock:
+            self.mailbox.idlers.add(self)
+        return '+ idling\r\n'
+
+    def end_idle(self, line):
+        tag, self.idle_tag = self.idle_tag, None
+        with self.mailbox.lock:
+            self.mailbox.idlers.discard(self)
+        if line.upper() != 'DONE':
+            return '%s BAD Expected DONE\r\n' % tag
+        return '%s OK IDLE terminated\r\n' % tag
+
+    def cmd_noop(self, tag, args):
+        return '%s OK NOOP completed\r\n' % tag
+
+    def cmd_login(self, tag, args):
+        mailbox = self.server.mailboxes.get(args[0].lower(), None)
+        if mailbox is None or mailbox.password != args[1]:
+            return '%s NO [AUTHENTICATIONFAILED] Invalid credentials\r\n' % tag
+        self.mailbox = mailbox
+        return '%s OK LOGIN completed\r\n' % tag
+
+    def cmd_select(self, tag, args):
+        if not self.mailbox:
+            return '%s BAD Not logged in\r\n' % tag
+        self.selected = True
+        with self.mailbox.lock:
+            return ('* %d EXISTS\r\n* 0 RECENT\r\n* OK [UIDVALIDITY %d] UIDs valid\r\n* OK [UIDNEXT %d] Predicted next UID\r\n'
+                '* FLAGS (\\Seen)\r\n%s OK [READ-WRITE] SELECT completed\r\n') % (len(self.mailbox.mails),
+                self.mailbox.uid_validity, self.mailbox.next_uid, tag)
+    cmd_examine = cmd_select
+
+    def cmd_close(self, tag, args):
+        self.selected = False
+        return '%s OK CLOSE completed\r\n' % tag
+
+    def cmd_logout(self, tag, args):
+        return '* BYE Logging out\r\n%s OK LOGOUT completed\r\n' % tag
+
+    def handle_uid(self, tag, command, args):
+        if not self.selected:
+            return '%s BAD No mailbox selected\r\n' % tag
+        with self.mailbox.lock:
+            mails = list(self.mailbox.mails)
+        max_uid = mails[-1].uid if mails else 0
+        if command == 'SEARCH':
+            keys = []
+            i = 0
+            while i < len(args):
+                key, i = parse_search_key(args, i, max_uid)
+                keys.append(key)
+            uids = [str(m.uid) for m in mails if all(key(m) for key in keys)]
+            return '* SEARCH %s\r\n%s OK SEARCH completed\r\n' % (' '.join(uids), tag)
+
+        uid_set = parse_uid_set(args[0], max_uid)
+        selected = [(seq + 1, m) for seq, m in enumerate(mails) if uid_set(m.uid)]
+        out = []
+        if command == 'FETCH':
+            items = ' '.join(args[1:]).upper()
+            for seq, mail in selected:
+                if 'HEADER.FIELDS' in items:
+                    name, literal = 'BODY[HEADER.FIELDS (FROM SUBJECT)]', mail.get_header_fields()
+                else:
+                    m = re.search(r'BODY\.PEEK\[\]<(\d+)\.(\d+)>', items)
+                    if m:
+                        start, size = int(m.group(1)), int(m.group(2))
+                        name, literal = 'BODY[]<%d>' % start, mail.raw[start:start + size]
+                    else:
+                        name, literal = 'BODY[]', mail.raw
+                with self.server.stats.lock:
+                    self.server.stats.fetched_bytes += len(literal)
+                out.append('* %d FETCH (UID %d %s {%d}\r\n%s)\r\n' % (seq, mail.uid, name, len(literal), literal))
+            return ''.join(out) + '%s OK FETCH completed\r\n' % tag
+        if command == 'STORE':
+            mode = args[1].upper()
+            for seq, mail in selected:
+                if '\\SEEN' in ' '.join(args[2:]).upper():
+                    mail.seen = not mode.startswith('-')
+                if not mode.endswith('.SILENT'):
+                    out.append('* %d FETCH (UID %d FLAGS (%s))\r\n' % (seq, mail.uid, '\\Seen' if mail.seen else ''))
+            return ''.join(out) + '%s OK STORE completed\r\n' % tag
+        return '%s BAD Unsupported UID command\r\n' % tag
+
+def parse_uid_set(uid_set, max_uid):
+    """Returns a predicate telling if a uid is in the IMAP sequence set."""
+    ranges = []
+    for part in uid_set.split(','):
+        if ':' in part:
+            a, b = part.split(':')
+            a = max_uid if a == '*' else int(a)
+            b = max_uid if b == '*' else int(b)
+            ranges.append((min(a, b), max(a, b)))
+        else:
+            n = max_uid if part == '*' else int(part)
+            ranges.append((n, n))
+    return lambda uid: any(a <= uid <= b for a, b in ranges)
+
+def parse_search_key(args, i, max_uid):
+    """Returns (predicate on FakeMail, index of the next key)."""
+    key = args[i].upper()
+    if key == '(':
+        keys = []
+        i += 1
+        while args[i] != ')':
+            k, i = parse_search_key(args, i, max_uid)
+            keys.append(k)
+        return (lambda m: all(k(m) for k in keys)), i + 1
+    if key == 'OR':
+        a, i = parse_search_key(args, i + 1, max_uid)
+        b, i = parse_search_key(args, i, max_uid)
+        return (lambda m: a(m) or b(m)), i
+    if key == 'FROM':
+        value = args[i + 1].lower()
+        return (lambda m: value in m.from_email.lower()), i + 2
+    if key == 'UID':
+        uid_set = parse_uid_set(args[i + 1], max_uid)
+        return (lambda m: uid_set(m.uid)), i + 2
+    if key == 'UNSEEN':
+        return (lambda m: not m.seen), i + 1
+    if key == 'ALL':
+        return (lambda m: True), i + 1
+    raise ValueError('Unsupported search key %s' % key)
+
+class FakeImapServer(object):
+    """IMAP4 server over the given FakeMailboxes, for load testing the poller without real accounts.
+    Only what MailClient uses is implemented: LOGIN, SELECT, UID SEARCH (UID, UNSEEN, FROM, OR and
+    ALL keys), UID FETCH of headers or (partial) bodies, UID STORE of \\Seen, NOOP, CLOSE and LOGOUT.
+    IDLE and COMPRESS=DEFLATE are offered when idle and compress are set, and with certfile, a pem
+    file holding the key and certificate, connections are served over TLS.
+
+    Each response is held back latency secs from when its command arrived, without holding back the
+    reading of later commands, so that pipelined commands overlap like they would on a real link.
+    drop_rate is the chance of any command making the server drop the connection instead. Port 0
+    picks a free port.
+    """
+
+    def __init__(self, mailboxes, host='127.0.0.1', port=0, latency=0.0, drop_rate=0.0, idle=False,
+            compress=False, certfile=None):
+        self.mailboxes = dict((m.email.lower(), m) for m in mailboxes)
+        self.latency = latency
+        self.drop_rate = drop_rate
+        self.idle = idle
+        self.compress = compress
+        self.certfile = certfile
+        self.stats = ServerStats()
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, port))
+        self.sock.listen(128)
+        self.host, self.port = self.sock.getsockname()
+
+    def start(self):
+        t = threading.Thread(target=self._accept_loop, name='fake-imap')
+        t.daemon = True
+        t.start()
+
+    def _accept_loop(self):
+        while True:
+            conn, _ = self.sock.accept()
+            with self.stats.lock:
+                self.stats.connections += 1
+            if self.certfile:
+                conn = serve_tls(conn, self.certfile)
+            t = threading.Thread(target=FakeImapSession(self, conn).run)
+            t.daemon = True
+            t.start()
+
+class FakeSmtpServer(object):
+    """Accepts any login and keeps the mails sent to it, as (from, [to], message) tuples. With certfile
+    connections are served over TLS, like FakeImapServer."""
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, certfile=None):
+        self.latency = latency
+        self.certfile = certfile
+        self.connections = 0
+        self.received = []
+        self.lock = threading.Lock()
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, port))
+        self.sock.listen(16)
+        self.host, self.port = self.sock.getsockname()
+
+    def start(self):
+        t = threading.Thread(target=self._accept_loop, name='fake-smtp')
+        t.daemon = True
+        t.start()
+
+    def _accept_loop(self):
+        while True:
+            conn, _ = self.sock.accept()
+            with self.lock:
+                self.connections += 1
+            if self.certfile:
+                conn = serve_tls(conn, self.certfile)
+            t = threading.Thread(target=self._serve, args=(conn,))
+            t.daemon = True
+            t.start()
+
+    def _serve(self, conn):
+        f = conn.makefile('rb')
+        def send(line):
+            time.sleep(self.latency)
+            conn.sendall(line + '\r\n')
+        mail_from, rcpts = None, []
+        try:
+            send('220 fake.smtp ESMTP ready')
+            while True:
+                line = f.readline()
+                if not line:
+                    return
+                command = line.strip().split(' ', 1)[0].upper()
+                if command in ('EHLO', 'HELO'):
+                    send('250-fake.smtp\r\n250-AUTH PLAIN LOGIN\r\n250 8BITMIME')
+                elif command == 'AUTH':
+                    if 'LOGIN' in line.upper() and len(line.split()) == 2:
+                        send('334 VXNlcm5hbWU6')
+                        f.readline()
+                        send('334 UGFzc3dvcmQ6')
+                        f.readline()
+                    elif 'LOGIN' in line.upper():
+                        send('334 UGFzc3dvcmQ6')
+                        f.readline()
+                    send('235 Authentication successful')
+                elif command == 'MAIL':
+                    mail_from, rcpts = line.split(':', 1)[1].strip(), []
+                    send('250 OK')
+                elif command == 'RCPT':
+                    rcpts.append(line.split(':', 1)[1].strip())
+                    send('250 OK')
+                elif command == 'DATA':
+                    send('354 End data with <CR><LF>.<CR><LF>')
+                    lines = []
+                    while True:
+                        l = f.readline()
+                        if not l or l in ('.\r\n', '.\n'):
+                            break
+                        lines.append(l[1:] if l.startswith('..') else l)
+                    with self.lock:
+                        self.received.append((mail_from, rcpts, ''.join(lines)))
+                    send('250 OK queued')
+                elif command == 'QUIT':
+                    send('221 Bye')
+                    return
+                else: # RSET, NOOP and the rest.
+                    send('250 OK')
+        except socket.error:
+            pass
+        finally:
+            conn.close()
@@ -0,0 +1,246 @@
+"""Load test of the poller against fake_mail_server. Run from the project root:
+
+    python -m cclogger.tests.load_test --mailboxes 200 --mails 20 --latency 0.05 --duration 60
+
+It adds mailboxes of the domain loadtest.invalid to the configured DB, polls them using
+poll_main.process_new for the given duration and deletes them afterwards. Use a scratch DB.
+Admin alerts raised meanwhile go to admin@loadtest.invalid through the outbox and the fake SMTP server.
+
+--tls, --compress and --idle exercise the TLS, COMPRESS=DEFLATE and IDLE paths, e.g.
+
+    python -m cclogger.tests.load_test --tls --compress --mix citi=0.8,noise=0.2
+"""
+
+import argparse
+import logging
+import os
+import random
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+
+import cclogger
+
+LOAD_TEST_DOMAIN = 'loadtest.invalid'
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Load test of the poller against fake IMAP and SMTP servers.')
+    parser.add_argument('--mailboxes', type=int, default=50, help='Number of mailboxes.')
+    parser.add_argument('--mails', type=int, default=20, help='Mails in each mailbox at the start.')
+    parser.add_argument('--new-mail-rate', type=float, default=5.0,
+        help='Mails per sec added to random mailboxes during the run.')
+    parser.add_argument('--mix', default='citi=0.4,hdfc=0.2,noise=0.4',
+        help='Share of each kind of generated mail. The kinds are citi, hdfc and noise.')
+    parser.add_argument('--latency', type=float, default=0.02, help='Secs each IMAP response is delayed by.')
+    parser.add_argument('--smtp-latency', type=float, default=0.0, help='Secs each SMTP response is delayed by.')
+    parser.add_argument('--drop-rate', type=float, default=0.0,
+        help='Chance of an IMAP command making the server drop the connection.')
+    parser.add_argument('--duration', type=float, default=30, help='Secs to run.')
+    parser.add_argument('--min-interval', type=float, default=1, help='Min secs between polls of a mailbox.')
+    parser.add_argument('--max-interval', type=float, default=10, help='Max secs between polls of a mailbox.')
+    parser.add_argument('--tls', action='store_true', help='Serve IMAP and SMTP over TLS.')
+    parser.add_argument('--certfile', default=None,
+        help='Pem file with the key and certificate for --tls. A self-signed one is made using openssl if not given.')
+    parser.add_argument('--compress', action='store_true', help='Offer COMPRESS=DEFLATE and have the mailboxes use it.')
+    parser.add_argument('--idle', action='store_true',
+        help='Offer IDLE and watch the mailboxes using it after their first poll, as poll_mode idle does.')
+    parser.add_argument('--seed', type=int, default=None, help='Seed for the generated mails.')
+    parser.add_argument('--verbose', action='store_true', help='Keep the verbose setting of settings.ini.')
+    return parser.parse_args()
+
+def make_self_signed_cert(directory):
+    """Makes a throwaway certificate for localhost using the openssl command. Returns the path of a pem file
+    holding the key and the certificate."""
+    key, cert = os.path.join(directory, 'key.pem'), os.path.join(directory, 'cert.pem')
+    with open(os.devnull, 'w') as devnull:
+        try:
+            subprocess.check_call(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+                '-subj', '/CN=localhost', '-keyout', key, '-out', cert], stdout=devnull, stderr=devnull)
+        except (OSError, subprocess.CalledProcessError), e:
+            raise SystemExit('Could not make a certificate using openssl: %s. Give one using --certfile.' % e)
+    path = os.path.join(directory, 'server.pem')
+    with open(path, 'w') as out:
+        for part in (key, cert):
+            with open(part) as f:
+                out.write(f.read())
+    return path
+
+def setup_db(imap, smtp, mailboxes, use_ssl, use_compress):
+    from ..model import db, UserMail, InMailServerConfig, OutMailServerConfig
+    from ..common_util import encrypt
+
+    others = UserMail.select_pollable().where(UserMail.in_mail_config << InMailServerConfig.select(
+        InMailServerConfig.id).where(InMailServerConfig.at_domain != LOAD_TEST_DOMAIN)).count()
+    if others:
+        raise SystemExit('The DB has %d real mailboxes, which would be polled too. Use a scratch DB.' % others)
+
+    cleanup_db()
+    with db.transaction():
+        in_conf = InMailServerConfig.create(at_domain=LOAD_TEST_DOMAIN, hostname=imap.host, port=imap.port,
+            use_ssl=use_ssl, use_compress=use_compress)
+        out_conf = OutMailServerConfig.create(at_domain=LOAD_TEST_DOMAIN, hostname=smtp.host, port=smtp.port,
+            use_ssl=use_ssl)
+        for mailbox in mailboxes:
+            UserMail.create(email=mailbox.email, password=encrypt(mailbox.password, True), is_dummy=False,
+                in_mail_config=in_conf, out_mail_config=out_conf)
+
+def cleanup_db():
+    from ..model import db, UserMail, TransactionAlert, InMailServerConfig, OutMailServerConfig, OutboxMail
+
+    with db.transaction():
+        # Admin alerts of the test which could not be sent.
+        ids = [m.id for m in OutboxMail.select() if LOAD_TEST_DOMAIN in m.to_addresses]
+        if ids:
+            OutboxMail.delete().where(OutboxMail.id << ids).execute()
+        ids = [u.id for u in UserMail.select().join(InMailServerConfig).where(
+            InMailServerConfig.at_domain == LOAD_TEST_DOMAIN)]
+        if ids:
+            TransactionAlert.delete().where(TransactionAlert.user_mail << ids).execute()
+            UserMail.delete().where(UserMail.id << ids).execute()
+        InMailServerConfig.delete().where(InMailServerConfig.at_domain == LOAD_TEST_DOMAIN).execute()
+        OutMailServerConfig.delete().where(OutMailServerConfig.at_domain == LOAD_TEST_DOMAIN).execute()
+
+def count_alerts():
+    from ..model import db, UserMail, TransactionAlert, InMailServerConfig
+
+    db.connect()
+    try:
+        return TransactionAlert.select().join(UserMail).join(InMailServerConfig).where(
+            InMailServerConfig.at_domain == LOAD_TEST_DOMAIN).count()
+    finally:
+        db.close()
+
+def count_queued_mails():
+    from ..model import db, OutboxMail
+
+    db.connect()
+    try:
+        return OutboxMail.select().count()
+    finally:
+        db.close()
+
+def add_mails_loop(mailboxes, rate, stop):
+    while not stop.is_set():
+        random.choice(mailboxes).add_mail()
+        stop.wait(random.expovariate(rate))
+
+def main():
+    args = parse_args()
+    if not args.verbose:
+        # Must be set before the other modules import them.
+        cclogger.verbose = False
+        cclogger.info = False
+        logging.getLogger('peewee').setLevel(logging.INFO)
+    random.seed(args.seed)
+
+    from .fake_mail_server import FakeMailbox, FakeImapServer, FakeSmtpServer, parse_mix
+    from .. import client, outbox, poll_main
+    from ..compress import compression_stats
+    from ..scheduler import PollScheduler
+
+    try:
+        mix = parse_mix(args.mix)
+    except ValueError, e:
+        raise SystemExit(str(e))
+
+    cert_dir = None
+    certfile = args.certfile if args.tls else None
+    if args.tls and not certfile:
+        cert_dir = tempfile.mkdtemp(prefix='cclogger-load-test-')
+        certfile = make_self_signed_cert(cert_dir)
+
+    mailboxes = [FakeMailbox('user%d@%s' % (i, LOAD_TEST_DOMAIN), 'secret%d' % i, mix) for i in range(args.mailboxes)]
+    for mailbox in mailboxes:
+        for i in range(args.mails):
+            mailbox.add_mail()
+
+    imap = FakeImapServer(mailboxes, latency=args.latency, drop_rate=args.drop_rate, idle=args.idle,
+        compress=args.compress, certfile=certfile)
+    smtp = FakeSmtpServer(latency=args.smtp_latency, certfile=certfile)
+    imap.start()
+    smtp.start()
+    client.server_mail_host, client.server_mail_port, client.server_mail_use_ssl = smtp.host, smtp.port, args.tls
+    # Admin alerts go through the outbox to the fake SMTP server, not to the configured admins.
+    outbox.admin_emails = [('Load test admin', 'admin@' + LOAD_TEST_DOMAIN)]
+
+    poll_main.db.connect()
+    try:
+        setup_db(imap, smtp, mailboxes, args.tls, args.compress)
+    finally:
+        poll_main.db.close()
+
+    poll_main.poll_scheduler = PollScheduler(args.min_interval, args.max_interval, 1.5)
+    polls = [0]
+    polls_lock = threading.Lock()
+    process_usermail = poll_main.process_usermail
+    def counted_process_usermail(usermail):
+        with polls_lock:
+            polls[0] += 1
+        return process_usermail(usermail)
+    poll_main.process_usermail = counted_process_usermail
+
+    stop = threading.Event()
+    adder = threading.Thread(target=add_mails_loop, args=(mailboxes, args.new_mail_rate, stop))
+    adder.daemon = True
+    if args.new_mail_rate > 0:
+        adder.start()
+
+    poll_main.outbox_sender.start()
+    if args.idle:
+        poll_main.start_idle_listener()
+
+    cycle_times = []
+    start = time.time()
+    try:
+        while time.time() - start < args.duration and not poll_main.shutdown_requested.is_set():
+            cycle_start = time.time()
+            poll_main.process_new()
+            cycle_times.append(time.time() - cycle_start)
+            time.sleep(min(poll_main.seconds_till_next_cycle(), max(0, args.duration - (time.time() - start))))
+        elapsed = time.time() - start
+        stop.set()
+        if adder.is_alive():
+            adder.join()
+
+        watched = len(poll_main.idle_listener.sessions) if poll_main.idle_listener else 0
+        poll_main.outbox_sender.drain(flush=True) # Admin alerts still in the digest window.
+        queued = count_queued_mails()
+        alerts = count_alerts()
+        stats = imap.stats.get_stats()
+        cycle_times.sort()
+        print 'Mailboxes: %d, polls: %d, elapsed: %.1f secs.' % (len(mailboxes), polls[0], elapsed)
+        print 'Alerts saved: %d (%.1f mails/sec).' % (alerts, alerts / elapsed)
+        if cycle_times:
+            print 'Poll cycle time: mean %.3f, median %.3f, max %.3f secs over %d cycles.' % (
+                sum(cycle_times) / len(cycle_times), cycle_times[len(cycle_times) / 2], cycle_times[-1],
+                len(cycle_times))
+        print 'IMAP: %(connections)d connections, %(commands)d commands, %(round_trips)d round trips, ' \
+            '%(dropped)d dropped, %(fetched_bytes)d bytes fetched.' % stats
+        if polls[0]:
+            print 'Round trips per poll: %.2f.' % (float(stats['mailbox_round_trips']) / polls[0])
+        if args.compress:
+            compression = compression_stats.get_stats()
+            compression['sessions'] = stats['compressed_sessions']
+            print 'IMAP compression: %(sessions)d sessions, %(wire_in)d bytes received for %(plain_in)d ' \
+                '(ratio %(ratio_in).2f).' % compression
+        if args.idle:
+            print 'IDLE: %d mailboxes watched, %d new mail pushes.' % (watched, stats['idle_pushes'])
+        print 'SMTP: %d connections, %d mails received, %d queued mails left unsent.' % (smtp.connections,
+            len(smtp.received), queued)
+    finally:
+        stop.set()
+        if poll_main.idle_listener:
+            poll_main.idle_listener.retain(set())
+        poll_main.client_manager.close_idle()
+        if cert_dir:
+            shutil.rmtree(cert_dir, ignore_errors=True)
+        poll_main.db.connect()
+        try:
+            cleanup_db()
+        finally:
+            poll_main.db.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,24 @@
+"""Points the models at a fresh sqlite DB, so that DB code can be tested without MySQL."""
+import os
+import tempfile
+
+from .. import peewee
+from .. import model
+
+def use_sqlite(*models):
+    """Swaps model.db to a new sqlite file with tables for models. Returns a function removing the file."""
+    fd, path = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    if not model.db.is_closed():
+        model.db.close()
+    model.db.__class__ = peewee.SqliteDatabase
+    model.db.init(path)
+    model.db.field_overrides = dict(peewee.SqliteDatabase.field_overrides)
+    model.db.op_overrides = dict(peewee.SqliteDatabase.op_overrides)
+    for m in models:
+        m.create_table()
+
+    def cleanup():
+        model.db.close()
+        os.remove(path)
+    return cleanup
@@ -0,0 +1,164 @@
+import collections
+import imaplib
+import time
+import unittest
+
+from .. import client as client_module
+from ..client import MailClient, MailClientManager, parse_fetch_response, compact_uid_set, or_search_keys
+from ..common_util import Bunch
+
+class StubImap(object):
+    """Stands in for an imaplib connection. Records the commands sent and answers
+    each with the untagged data returned by respond(command args)."""
+    abort = imaplib.IMAP4.abort
+    error = imaplib.IMAP4.error
+    state = 'SELECTED'
+
+    uid = imaplib.IMAP4.uid.im_func
+    _simple_command = imaplib.IMAP4._simple_command.im_func
+
+    def __init__(self, respond):
+        self.respond = respond
+        self.sent = list()
+        self.pending = collections.deque()
+
+    def _command(self, name, *args):
+        self.sent.append((name,) + args)
+        tag = 'T%d' % len(self.sent)
+        self.pending.append((tag, self.respond(args)))
+        return tag
+
+    def _command_complete(self, name, tag):
+        pending_tag, self.current = self.pending.popleft()
+        assert pending_tag == tag
+        return 'OK', ['%s completed' % name]
+
+    def _untagged_response(self, typ, dat, name):
+        return typ, self.current
+
+def make_client(respond):
+    client = MailClient(Bunch(hostname='localhost', port=143, use_ssl=False), None, 'user', 'secret')
+    client.mail = StubImap(respond)
+    return client
+
+class Unconnected(imaplib.IMAP4):
+    def __init__(self):
+        pass
+
+def quoted_by_imaplib(arg):
+    return Unconnected()._checkquote(arg) != arg
+
+class ParseFetchResponseTest(unittest.TestCase):
+
+    def test_splits_messages_and_names_literals(self):
+        data = [('1 (UID 5 BODY[]<0> {5}', 'hello'), ')',
+            ('2 (FLAGS (\\Seen) UID 7 BODY[HEADER.FIELDS (FROM SUBJECT)] {4}', 'From'), ' RFC822.SIZE 20)']
+        self.assertEqual([
+            ('5', '1 (UID 5 )', {'BODY[]<0>': 'hello'}),
+            ('7', '2 (FLAGS (\\Seen) UID 7  RFC822.SIZE 20)', {'BODY[HEADER.FIELDS (FROM SUBJECT)]': 'From'})
+        ], parse_fetch_response(data))
+
+    def test_messages_without_uid_are_left_out(self):
+        data = ['3 (FLAGS (\\Seen))', ('4 (UID 9 BODY[] {2}', 'hi'), ')', None]
+        self.assertEqual([('9', '4 (UID 9 )', {'BODY[]': 'hi'})], parse_fetch_response(data))
+
+    def test_empty(self):
+        self.assertEqual([], parse_fetch_response([None]))
+
+class CompactUidSetTest(unittest.TestCase):
+
+    def test_runs_become_ranges(self):
+        self.assertEqual('1:3,7,9:10', compact_uid_set(['3', '1', '2', '7', '10', '9']))
+
+    def test_duplicates_and_single(self):
+        self.assertEqual('4', compact_uid_set(['4', '4']))
+
+class OrSearchKeysTest(unittest.TestCase):
+
+    def test_single_key(self):
+        self.assertEqual('FROM "a"', or_search_keys(['FROM "a"']))
+
+    def test_nesting_is_balanced(self):
+        self.assertEqual('OR OR A B OR C D', or_search_keys(['A', 'B', 'C', 'D']))
+        self.assertEqual('OR A OR B C', or_search_keys(['A', 'B', 'C']))
+
+class GetNewMailUidsTest(unittest.TestCase):
+
+    def test_incremental_search_is_parenthesized(self):
+        client = make_client(lambda args: ['3 4 7'])
+        uids = client.get_new_mail_uids(since_uid=4)
+
+        self.assertEqual([('UID', 'SEARCH', None, '(UID 4:*)')], client.mail.sent)
+        self.assertFalse(quoted_by_imaplib(client.mail.sent[0][3]))
+        self.assertEqual(['4', '7'], sorted(uids))
+
+    def test_unseen_search(self):
+        client = make_client(lambda args: ['5'])
+        self.assertEqual(['5'], client.get_new_mail_uids())
+        self.assertEqual([('UID', 'SEARCH', None, '(UNSEEN)')], client.mail.sent)
+
+    def test_sender_batches_are_parenthesized(self):
+        client = make_client(lambda args: ['9'])
+        client.get_new_mail_uids(since_uid=9, from_emails=['a@x.com', 'b@x.com', 'c@x.com'])
+
+        self.assertEqual([('UID', 'SEARCH', None, '(UID 9:* OR FROM "a@x.com" OR FROM "b@x.com" FROM "c@x.com")')],
+            client.mail.sent)
+        self.assertFalse(quoted_by_imaplib(client.mail.sent[0][3]))
+
+    def test_unparenthesized_criteria_would_be_quoted(self):
+        self.assertTrue(quoted_by_imaplib('UID 4:*'))
+
+def envelope(seq, uid, from_email):
+    return [('%d (UID %s BODY[HEADER.FIELDS (FROM SUBJECT)] {40}' % (seq, uid),
+        'From: %s\r\nSubject: Alert %s\r\n\r\n' % (from_email, uid)), ')']
+
+class FetchBatchesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.fetch_batch_size = client_module.fetch_batch_size
+        client_module.fetch_batch_size = 2
+
+    def tearDown(self):
+        client_module.fetch_batch_size = self.fetch_batch_size
+
+    def test_responses_are_matched_by_uid_not_by_tag(self):
+        # All the FETCH responses of the window get read before the first tagged response.
+        responses = [envelope(3, '12', 'c@x.com') + envelope(1, '10', 'a@x.com') + envelope(2, '11', 'b@x.com'), []]
+        client = make_client(lambda args: responses.pop(0))
+
+        self.assertEqual([('10', 'a@x.com', 'Alert 10'), ('11', 'b@x.com', 'Alert 11'), ('12', 'c@x.com', 'Alert 12')],
+            list(client.fetch_envelopes(['10', '11', '12'])))
+        self.assertEqual(['10,11', '12'], [args[2] for args in client.mail.sent])
+
+    def test_missing_uids_are_skipped(self):
+        client = make_client(lambda args: envelope(1, '10', 'a@x.com'))
+        self.assertEqual(['10'], [uid for uid, _, _ in client.fetch_envelopes(['10', '11'])])
+
+class LoggedIn(object):
+    def __init__(self):
+        self.calls = list()
+
+    def close(self):
+        self.calls.append('close')
+
+    def logout(self):
+        self.calls.append('logout')
+
+class CloseIdleTest(unittest.TestCase):
+
+    def test_logs_out_idle_clients_only(self):
+        manager = MailClientManager()
+        idle = make_client(None)
+        idle.mail = idle_mail = LoggedIn()
+        busy = make_client(None)
+        busy.mail = busy_mail = LoggedIn()
+        manager.idle_clients['idle@x.com'] = (idle, 'p', time.time())
+        manager.checked_out['busy@x.com'] = (busy, 'p')
+
+        manager.close_idle()
+        self.assertEqual(['close', 'logout'], idle_mail.calls)
+        self.assertEqual([], busy_mail.calls)
+        self.assertFalse(manager.idle_clients)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+import imaplib
+import unittest
+import zlib
+
+from ..compress import DeflateStream, enable_deflate
+
+class StubImap(object):
+    abort = imaplib.IMAP4.abort
+    error = imaplib.IMAP4.error
+
+    def __init__(self, result):
+        self.result = result
+
+    def _simple_command(self, name, *args):
+        if isinstance(self.result, Exception):
+            raise self.result
+        return self.result
+
+class EnableDeflateTest(unittest.TestCase):
+
+    def test_bad_response_leaves_connection_uncompressed(self):
+        mail = StubImap(imaplib.IMAP4.error('COMPRESS command error: BAD [\'Unknown command\']'))
+        self.assertFalse(enable_deflate(mail))
+        self.assertFalse(hasattr(mail, 'deflate'))
+
+    def test_refusal_leaves_connection_uncompressed(self):
+        mail = StubImap(('NO', ['Compression already active']))
+        self.assertFalse(enable_deflate(mail))
+        self.assertFalse(hasattr(mail, 'deflate'))
+
+    def test_abort_is_raised(self):
+        mail = StubImap(imaplib.IMAP4.abort('socket error: EOF'))
+        self.assertRaises(imaplib.IMAP4.abort, enable_deflate, mail)
+
+class DeflateStreamTest(unittest.TestCase):
+
+    def test_reads_what_the_peer_compressed(self):
+        peer = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+        wire = peer.compress('* OK first\r\n* 1 FETCH {5}\r\nhello)\r\n') + peer.flush(zlib.Z_SYNC_FLUSH)
+        chunks = [wire[i:i + 7] for i in range(0, len(wire), 7)]
+        stream = DeflateStream(lambda size: chunks.pop(0), None)
+
+        self.assertEqual('* OK first\r\n', stream.readline())
+        self.assertEqual('* 1 FETCH {5}\r\n', stream.readline())
+        self.assertEqual('hello', stream.read(5))
+        self.assertEqual(')\r\n', stream.readline())
+
+    def test_sent_commands_are_flushed(self):
+        sent = []
+        stream = DeflateStream(None, sent.append)
+        stream.send('a1 NOOP\r\n')
+        self.assertEqual('a1 NOOP\r\n', zlib.decompressobj(-15).decompress(''.join(sent)))
+
+if __name__ == '__main__':
+    unittest.main()
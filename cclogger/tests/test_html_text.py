@@ -0,0 +1,29 @@
+import unittest
+
+from ..html_text import html_to_text, normalize_text
+
+class HtmlToTextTest(unittest.TestCase):
+
+    def test_blocks_and_cells(self):
+        html = '<table><tr><td>Amount</td><td>INR 500</td></tr><tr><td>Place</td><td>BIG BAZAAR</td></tr></table>'
+        self.assertEqual(u'Amount INR 500\nPlace BIG BAZAAR\n', html_to_text(html))
+
+    def test_entities_and_char_refs(self):
+        self.assertEqual(u'A & B \xe9\xe9 \u20ac &bogus;\n', html_to_text('<p>A &amp; B &eacute;&#233; &#x20AC; &bogus;</p>'))
+
+    def test_scripts_and_styles_are_skipped(self):
+        html = '<html><head><style>p { color: red }</style></head><body><script>var x = 1;</script>Hi</body></html>'
+        self.assertEqual(u'Hi\n', html_to_text(html))
+
+    def test_markup_newlines_are_spaces_except_in_pre(self):
+        self.assertEqual(u'one two\nthree\nfour\n', html_to_text('<p>one\ntwo</p><pre>three\nfour</pre>'))
+
+    def test_utf8_str(self):
+        self.assertEqual(u'caf\xe9\n', html_to_text('<b>caf\xc3\xa9</b>'))
+
+    def test_normalize_text(self):
+        self.assertEqual(u'a b\nc\n', normalize_text(u'  a \t b \n\n \xa0\n c  '))
+        self.assertEqual(u'', normalize_text(u' \n '))
+
+if __name__ == '__main__':
+    unittest.main()
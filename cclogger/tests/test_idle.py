@@ -0,0 +1,131 @@
+import resource
+import socket
+import threading
+import unittest
+
+from .. import idle
+from ..common_util import Bunch
+from ..idle import FdPoller, IdleListener
+
+class StubSession(object):
+    """IdleSession reading one end of a socket pair."""
+
+    def __init__(self, usermail_id):
+        self.usermail = Bunch(id=usermail_id, email='user%d@example.com' % usermail_id)
+        self.sock, self.peer = socket.socketpair()
+        self.closed = False
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def read_events(self):
+        return 'EXISTS' in self.sock.recv(4096)
+
+    def renew_if_due(self):
+        return False
+
+    def close(self):
+        self.closed = True
+        self.sock.close()
+        self.peer.close()
+
+class FdPollerTest(unittest.TestCase):
+
+    def test_reports_readable_fds(self):
+        poller = FdPoller()
+        a, b = socket.socketpair()
+        c, d = socket.socketpair()
+        try:
+            poller.register(a.fileno())
+            poller.register(c.fileno())
+            self.assertEqual([], poller.poll(0))
+            b.sendall('x')
+            self.assertEqual([a.fileno()], poller.poll(1))
+            poller.unregister(a.fileno())
+            poller.unregister(a.fileno()) # Unknown fds are ignored.
+            self.assertEqual([], poller.poll(0))
+        finally:
+            for s in (a, b, c, d):
+                s.close()
+
+    def test_fds_beyond_fd_setsize(self):
+        if resource.getrlimit(resource.RLIMIT_NOFILE)[0] < 1100:
+            self.skipTest('Not allowed to open enough files.')
+        filler = [socket.socket() for i in range(1030)]
+        a, b = socket.socketpair()
+        try:
+            self.assertTrue(a.fileno() >= 1024)
+            poller = FdPoller()
+            poller.register(a.fileno())
+            b.sendall('x')
+            self.assertEqual([a.fileno()], poller.poll(1))
+        finally:
+            for s in filler + [a, b]:
+                s.close()
+
+class IdleListenerTest(unittest.TestCase):
+
+    def test_dispatches_new_mail_by_fd(self):
+        got = []
+        event = threading.Event()
+        def on_new_mail(usermail):
+            got.append(usermail.id)
+            event.set()
+
+        listener = IdleListener(on_new_mail)
+        sessions = [StubSession(i) for i in range(3)]
+        for session in sessions:
+            listener.sessions[session.usermail.id] = session
+        listener.start()
+
+        sessions[1].peer.sendall('* 4 EXISTS\r\n')
+        self.assertTrue(event.wait(10))
+        self.assertEqual([1], got)
+
+        listener.unwatch(1)
+        event.clear()
+        sessions[2].peer.sendall('* 5 EXISTS\r\n')
+        self.assertTrue(event.wait(10))
+        self.assertEqual([1, 2], got)
+        self.assertTrue(sessions[1].closed)
+        self.assertFalse(sessions[1] in listener.session_fds)
+
+class StubClient(object):
+    def __init__(self, uid_next):
+        self.uid_next = uid_next
+        self.use_compress = True
+
+    def open_connection(self):
+        pass
+
+    def has_capability(self, name):
+        return True
+
+class WatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = idle.MailClient, idle.IdleSession, idle.decrypt
+        idle.decrypt = lambda password, unused: password
+        idle.IdleSession = lambda usermail, client: Bunch(start=lambda: None, close=lambda: None)
+
+    def tearDown(self):
+        idle.MailClient, idle.IdleSession, idle.decrypt = self.saved
+
+    def watch(self, uid_next, last_uid):
+        idle.MailClient = lambda *args: StubClient(uid_next)
+        got = []
+        listener = IdleListener(lambda usermail: got.append(usermail.id))
+        usermail = Bunch(id=1, email='user1@example.com', password='p', in_mail_config=None, out_mail_config=None)
+        self.assertTrue(listener.watch(usermail, last_uid))
+        return got
+
+    def test_mail_which_came_before_idle_started_is_pushed(self):
+        self.assertEqual([1], self.watch(uid_next=12, last_uid=10))
+        self.assertEqual([1], self.watch(uid_next=None, last_uid=10))
+
+    def test_no_push_when_nothing_came(self):
+        self.assertEqual([], self.watch(uid_next=11, last_uid=10))
+        self.assertEqual([], self.watch(uid_next=12, last_uid=None))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+import datetime
+import unittest
+
+from .sqlite_db import use_sqlite
+from ..model import UserMail, InMailServerConfig, OutMailServerConfig, Poller
+from ..lease import LeaseManager
+
+class LeaseManagerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cleanup = use_sqlite(InMailServerConfig, OutMailServerConfig, UserMail, Poller)
+        i = InMailServerConfig.create(at_domain='example.com', hostname='imap.example.com', port=993, use_ssl=True)
+        o = OutMailServerConfig.create(at_domain='example.com', hostname='smtp.example.com', port=465, use_ssl=True)
+        for n in range(4):
+            UserMail.create(email='user%d@example.com' % n, password='x', is_dummy=False, in_mail_config=i,
+                out_mail_config=o)
+
+    def tearDown(self):
+        self.cleanup()
+
+    def expire(self, usermail):
+        past = datetime.datetime.utcnow() - datetime.timedelta(seconds=1)
+        UserMail.update(lease_expiry=past).where(UserMail.id == usermail.id).execute()
+
+    def test_claim_skips_expired_leases(self):
+        a = LeaseManager(60, 'a')
+        expired = a.claim()[0]
+        self.expire(expired)
+        LeaseManager(60, 'b').heartbeat(datetime.datetime.utcnow())
+
+        # a gives away one of its 3 live leases for b, and must not poll the lapsed one it still names.
+        mine = a.claim()
+        self.assertEqual(2, len(mine))
+        self.assertNotIn(expired.id, [u.id for u in mine])
+
+    def test_holds_renews_or_gives_up(self):
+        a = LeaseManager(60, 'a')
+        usermail = a.claim()[0]
+        self.assertTrue(a.holds(usermail))
+
+        # Close to expiry the lease is renewed.
+        a.expiries[usermail.id] = datetime.datetime.utcnow() + datetime.timedelta(seconds=5)
+        self.assertTrue(a.holds(usermail))
+        self.assertTrue(a.expiries[usermail.id] > datetime.datetime.utcnow() + datetime.timedelta(seconds=50))
+
+        # Once lapsed and taken over, it is not polled.
+        self.expire(usermail)
+        a.expiries[usermail.id] = datetime.datetime.utcnow()
+        UserMail.update(lease_owner='b').where(UserMail.id == usermail.id).execute()
+        self.assertFalse(a.holds(usermail))
+
+    def test_claim_removes_dead_pollers(self):
+        now = datetime.datetime.utcnow()
+        LeaseManager(60, 'dead').heartbeat(now - datetime.timedelta(seconds=61))
+        LeaseManager(60, 'b').heartbeat(now)
+
+        LeaseManager(60, 'a').claim()
+        self.assertEqual(['a', 'b'], sorted(p.name for p in Poller.select()))
+
+if __name__ == '__main__':
+    unittest.main()
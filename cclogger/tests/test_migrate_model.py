@@ -0,0 +1,42 @@
+import unittest
+
+from .sqlite_db import use_sqlite
+from .. import model
+from ..model import InMailServerConfig, UserMail, Poller, OutboxMail
+from ..migrate_model import get_columns, migrate
+
+class MigrateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cleanup = use_sqlite()
+        # The usermail table as created before the poller kept uid marks.
+        model.db.execute_sql('CREATE TABLE usermail (id INTEGER PRIMARY KEY, email VARCHAR(254) NOT NULL, '
+            'password VARCHAR(128) NOT NULL, in_mail_config_id INTEGER NOT NULL, out_mail_config_id INTEGER NOT NULL, '
+            'is_dummy SMALLINT NOT NULL, is_bad SMALLINT NOT NULL, error VARCHAR(100), is_sms SMALLINT NOT NULL)')
+        model.db.execute_sql("INSERT INTO usermail VALUES (1, 'a@x.com', 'p', -1, -1, 0, 0, NULL, 0)")
+        model.db.execute_sql('CREATE TABLE inmailserverconfig (id INTEGER PRIMARY KEY, at_domain VARCHAR(255) NOT NULL, '
+            'hostname VARCHAR(255) NOT NULL, port INTEGER NOT NULL, use_ssl SMALLINT NOT NULL)')
+        model.db.execute_sql("INSERT INTO inmailserverconfig VALUES (1, '@x.com', 'imap.x.com', 993, 1)")
+
+    def tearDown(self):
+        self.cleanup()
+
+    def test_adds_missing_columns_and_keeps_rows(self):
+        migrate()
+        self.assertTrue(set(f.db_column for f in UserMail._meta.get_fields()) <= get_columns(UserMail))
+        usermail = UserMail.get(UserMail.id == 1)
+        self.assertEqual('a@x.com', usermail.email)
+        self.assertEqual(0, usermail.last_uid)
+        self.assertEqual(None, usermail.uid_validity)
+        self.assertEqual(None, usermail.lease_owner)
+        self.assertTrue(Poller.table_exists())
+        self.assertTrue(InMailServerConfig.get(InMailServerConfig.id == 1).use_compress)
+        self.assertTrue(OutboxMail.table_exists())
+
+    def test_running_again_does_nothing(self):
+        migrate()
+        migrate()
+        self.assertEqual(1, UserMail.select().count())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,36 @@
+import unittest
+
+from ..mime import MimeEntity
+
+def entity(headers, body):
+    return MimeEntity('\r\n'.join(headers) + '\r\n\r\n' + body)
+
+class GetDecodedBodyTest(unittest.TestCase):
+
+    def test_base64_with_charset(self):
+        e = entity(['Content-Type: text/plain; charset=iso-8859-1', 'Content-Transfer-Encoding: base64'],
+            'Q2Fm6SAxMDAg\r\nUnMu\r\n')
+        self.assertEqual(u'Caf\xe9 100 Rs.', e.get_decoded_body())
+
+    def test_truncated_base64(self):
+        e = entity(['Content-Transfer-Encoding: base64'], 'aGVsbG8gd29y')
+        self.assertEqual(u'hello wor', e.get_decoded_body())
+        e = entity(['Content-Transfer-Encoding: base64'], 'aGVsbG8gd29ybG')
+        self.assertEqual(u'hello wor', e.get_decoded_body())
+
+    def test_quoted_printable(self):
+        e = entity(['Content-Type: text/html; charset=utf-8', 'Content-Transfer-Encoding: quoted-printable'],
+            '<p>INR=C2=A0500 at CAF=C3=89 =\r\nDAY</p>')
+        self.assertEqual(u'<p>INR\xa0500 at CAF\xc9 DAY</p>', e.get_decoded_body())
+
+    def test_unknown_charset_falls_back_to_utf8(self):
+        e = entity(['Content-Type: text/plain; charset=x-unknown'], 'caf\xc3\xa9 \xff')
+        self.assertEqual(u'caf\xe9 \ufffd', e.get_decoded_body())
+
+    def test_parts_of_multipart(self):
+        e = entity(['Content-Type: multipart/alternative; boundary="b1"'],
+            '--b1\r\nContent-Type: text/plain\r\n\r\nplain\r\n--b1\r\nContent-Type: text/html\r\n\r\n<p>html</p>\r\n--b1--\r\n')
+        self.assertEqual([u'plain', u'<p>html</p>'], [part.get_decoded_body() for part in e.get_parts()])
+
+if __name__ == '__main__':
+    unittest.main()
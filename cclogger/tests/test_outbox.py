@@ -0,0 +1,89 @@
+import datetime
+import threading
+import time
+import unittest
+
+from .sqlite_db import use_sqlite
+from ..model import OutboxMail
+from .. import outbox
+from ..outbox import OutboxSender
+
+class OutboxSenderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cleanup = use_sqlite(OutboxMail)
+        self.sent = list()
+        self.server_send_mail = outbox.server_send_mail
+        outbox.server_send_mail = lambda to, subject, body: self.sent.append(subject)
+
+    def tearDown(self):
+        outbox.server_send_mail = self.server_send_mail
+        self.cleanup()
+
+    def queue(self, subject, is_admin_alert=False, age=0):
+        OutboxMail.create(to_addresses='a@x.com', subject=subject, body='', is_admin_alert=is_admin_alert,
+            created=datetime.datetime.utcnow() - datetime.timedelta(seconds=age))
+
+    def test_mails_claimed_by_another_sender_are_not_sent(self):
+        self.queue('one')
+        self.queue('two')
+        self.assertEqual(2, len(OutboxSender('a').claim()))
+
+        OutboxSender('b').drain()
+        self.assertEqual([], self.sent)
+        OutboxSender('a').drain()
+        self.assertEqual(['one', 'two'], self.sent)
+        self.assertEqual(0, OutboxMail.select().count())
+
+    def test_drains_of_one_sender_do_not_overlap(self):
+        def slow_send(to, subject, body):
+            time.sleep(0.05)
+            self.sent.append(subject)
+        outbox.server_send_mail = slow_send
+        self.queue('one')
+        self.queue('two')
+
+        sender = OutboxSender('a')
+        t = threading.Thread(target=sender.drain)
+        t.start()
+        sender.drain(flush=True)
+        t.join()
+        self.assertEqual(['one', 'two'], self.sent)
+
+    def test_lapsed_claims_are_taken_over(self):
+        self.queue('one')
+        OutboxSender('a').claim()
+        past = datetime.datetime.utcnow() - datetime.timedelta(seconds=1)
+        OutboxMail.update(claim_expiry=past).execute()
+
+        OutboxSender('b').drain()
+        self.assertEqual(['one'], self.sent)
+
+    def test_alerts_wait_for_the_digest_window(self):
+        self.queue('alert', is_admin_alert=True)
+        sender = OutboxSender('a')
+        sender.drain()
+        self.assertEqual([], self.sent)
+        self.assertEqual(None, OutboxMail.get().claimed_by)
+
+        sender.drain(flush=True)
+        self.assertEqual(['alert'], self.sent)
+
+    def test_alerts_go_out_as_digest_once_the_window_closed(self):
+        self.queue('old', is_admin_alert=True, age=outbox.admin_digest_window + 1)
+        self.queue('new', is_admin_alert=True)
+        OutboxSender('a').drain()
+        self.assertEqual(['CCTracker: 2 alerts'], self.sent)
+
+    def test_failed_mails_are_released(self):
+        def fail(to, subject, body):
+            raise IOError('down')
+        outbox.server_send_mail = fail
+        self.queue('one')
+        OutboxSender('a').drain()
+
+        mail = OutboxMail.get()
+        self.assertEqual((1, None), (mail.attempts, mail.claimed_by))
+
+if __name__ == '__main__':
+    unittest.main()
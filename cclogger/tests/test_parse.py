@@ -0,0 +1,22 @@
+import unittest
+
+from ..parse import ParseCentral, SmsParseCentral
+
+class ParseCentralTest(unittest.TestCase):
+
+    def test_centrals_have_their_own_parsers(self):
+        mail_central = ParseCentral.getInstance()
+        sms_central = SmsParseCentral.getInstance()
+        self.assertIsNot(mail_central.get_parsers(), sms_central.get_parsers())
+        self.assertIn('lm-citibk', sms_central.get_parsers())
+
+    def test_tracked_from_emails_are_mail_senders_only(self):
+        self.assertEqual(['citialert.india@citicorp.com'], ParseCentral.getInstance().get_tracked_from_emails())
+
+    def test_sms_sender_is_not_a_mail_candidate(self):
+        central = ParseCentral.getInstance()
+        self.assertFalse(central.is_candidate('AM-HDFCBK', 'Transaction alert'))
+        self.assertTrue(central.is_candidate('CitiAlert.India@citicorp.com', 'Transaction confirmation on your Citibank credit card'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,35 @@
+import unittest
+
+from ..parse_cache import ParseCache, FIELDS, NOT_TRANSACTION
+
+class ParseCacheTest(unittest.TestCase):
+
+    def test_get_and_put(self):
+        cache = ParseCache(2)
+        key = ParseCache.make_key('CitiIndia', 'a@x.com', 'Subject', u'body')
+        self.assertEqual(None, cache.get(key))
+        cache.put(key, (NOT_TRANSACTION,))
+        self.assertEqual((NOT_TRANSACTION,), cache.get(key))
+        self.assertEqual({'hits': 1, 'misses': 1, 'hit_rate': 0.5, 'evictions': 0, 'size': 1}, cache.get_stats())
+
+    def test_least_recently_used_is_evicted(self):
+        cache = ParseCache(2)
+        cache.put('a', (FIELDS, 'r', {'amt': '1'}))
+        cache.put('b', (NOT_TRANSACTION,))
+        cache.get('a')
+        cache.put('c', (NOT_TRANSACTION,))
+        self.assertEqual(None, cache.get('b'))
+        self.assertNotEqual(None, cache.get('a'))
+        self.assertEqual(1, cache.get_stats()['evictions'])
+
+    def test_zero_size_keeps_nothing(self):
+        cache = ParseCache(0)
+        cache.put('a', (NOT_TRANSACTION,))
+        self.assertEqual(None, cache.get('a'))
+
+    def test_keys_tell_parts_apart(self):
+        self.assertNotEqual(ParseCache.make_key('ab', 'c'), ParseCache.make_key('a', 'bc'))
+        self.assertEqual(ParseCache.make_key(u'caf\xe9'), ParseCache.make_key('caf\xc3\xa9'))
+
+if __name__ == '__main__':
+    unittest.main()
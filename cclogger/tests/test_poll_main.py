@@ -0,0 +1,48 @@
+import time
+import unittest
+
+from .. import poll_main
+from ..common_util import Bunch
+from ..scheduler import PollScheduler
+
+class ProcessUsermailTest(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = poll_main.poll_usermail, poll_main.report_poll_exception, poll_main.poll_scheduler
+        self.reported = list()
+        poll_main.report_poll_exception = lambda e, stk: self.reported.append(str(e)) or True
+        poll_main.poll_scheduler = PollScheduler(10, 80, 2)
+
+    def tearDown(self):
+        poll_main.poll_usermail, poll_main.report_poll_exception, poll_main.poll_scheduler = self.saved
+
+    def test_mailbox_is_rescheduled_when_the_poll_fails(self):
+        def fail(usermail, outcome):
+            outcome.found_new = True
+            raise ValueError('Could not save the uid mark')
+        poll_main.poll_usermail = fail
+        usermail = Bunch(id=1, email='user1@example.com')
+        scheduler = poll_main.poll_scheduler
+        scheduler.sync([usermail])
+        self.assertEqual([usermail], scheduler.pop_due(time.time() + 10))
+
+        self.assertTrue(poll_main.process_usermail(usermail))
+        self.assertEqual(['Could not save the uid mark'], self.reported)
+        self.assertEqual([usermail], scheduler.pop_due(time.time() + 11))
+
+    def test_mailbox_being_retried_is_left_to_the_retry(self):
+        def retry(usermail, outcome):
+            poll_main.poll_scheduler.retry_later(usermail)
+            outcome.retrying = True
+            return True
+        poll_main.poll_usermail = retry
+        usermail = Bunch(id=1, email='user1@example.com')
+        scheduler = poll_main.poll_scheduler
+        scheduler.sync([usermail])
+        scheduler.pop_due(time.time() + 10)
+
+        self.assertTrue(poll_main.process_usermail(usermail))
+        self.assertEqual(1, scheduler.retry_attempts[1]) # done() would have reset it.
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,33 @@
+import unittest
+
+from ..prefilter import AnchorIndex
+
+def make_index(*anchors):
+    index = AnchorIndex()
+    for anchor, value in anchors:
+        index.add(anchor, value)
+    return index
+
+class AnchorIndexTest(unittest.TestCase):
+
+    def test_finds_anchors_case_insensitively(self):
+        index = make_index(('was spent on', 'citi'), ('Thank you for using', 'hdfc'))
+        self.assertEqual(set(['citi']), index.find('Rs 10 WAS SPENT ON your card'))
+        self.assertEqual(set(), index.find('Your statement is ready'))
+
+    def test_overlapping_and_nested_anchors(self):
+        index = make_index(('he', 1), ('she', 2), ('his', 3), ('hers', 4))
+        self.assertEqual(set([1, 2, 4]), index.find('ushers'))
+
+    def test_values_of_the_same_anchor(self):
+        index = make_index(('debited', 'a'), ('DEBITED', 'b'))
+        self.assertEqual(set(['a', 'b']), index.find('amount debited'))
+
+    def test_adding_rebuilds(self):
+        index = make_index(('credited', 1))
+        self.assertEqual(set(), index.find('debited'))
+        index.add('debited', 2)
+        self.assertEqual(set([2]), index.find('debited'))
+
+if __name__ == '__main__':
+    unittest.main()
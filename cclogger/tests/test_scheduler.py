@@ -0,0 +1,69 @@
+import time
+import unittest
+
+from ..common_util import Bunch
+from ..scheduler import PollScheduler
+
+def mailbox(i):
+    return Bunch(id=i, email='user%d@example.com' % i)
+
+class PollSchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.scheduler = PollScheduler(10, 80, 2, retry_base_delay=4, retry_max_delay=16, max_retries=3)
+        self.a, self.b = mailbox(1), mailbox(2)
+        self.scheduler.sync([self.a, self.b])
+
+    def pop_all(self):
+        return self.scheduler.pop_due(time.time() + 1000)
+
+    def test_new_mailboxes_fall_due_within_the_min_interval(self):
+        self.assertEqual([], self.scheduler.pop_due(time.time() - 1))
+        due = self.scheduler.pop_due(time.time() + 10)
+        self.assertEqual(set([1, 2]), set(u.id for u in due))
+        self.assertEqual([], self.pop_all()) # Popped ones wait for done().
+
+    def test_done_backs_off_quiet_mailboxes_and_speeds_up_busy_ones(self):
+        self.pop_all()
+        self.scheduler.done(self.a, False)
+        self.scheduler.done(self.b, True)
+        self.assertEqual(20, self.scheduler.entries[1].interval)
+        self.assertEqual(10, self.scheduler.entries[2].interval) # Not below min_interval.
+        self.assertEqual([self.b], self.scheduler.pop_due(time.time() + 15))
+
+        for i in range(5):
+            self.scheduler.done(self.b, False)
+            self.pop_all()
+        self.assertEqual(80, self.scheduler.entries[2].interval) # Not above max_interval.
+
+    def test_done_without_pop_is_ignored(self):
+        self.scheduler.done(self.a, False) # E.g. polled due to an IDLE push.
+        self.assertEqual(10, self.scheduler.entries[1].interval)
+        self.assertEqual(2, len(self.pop_all()))
+
+    def test_retry_later_backs_off_and_gives_up(self):
+        self.pop_all()
+        delays = [self.scheduler.retry_later(self.a) for i in range(4)]
+        self.assertTrue(2 <= delays[0] <= 4)
+        self.assertTrue(4 <= delays[1] <= 8)
+        self.assertTrue(8 <= delays[2] <= 16)
+        self.assertEqual(None, delays[3])
+        self.assertEqual([self.a], self.pop_all())
+
+        # A successful poll resets the attempts.
+        self.scheduler.retry_later(self.a)
+        self.scheduler.done(self.a, False)
+        self.assertNotIn(1, self.scheduler.retry_attempts)
+
+    def test_sync_drops_removed_mailboxes_and_keeps_the_rest(self):
+        c = mailbox(3)
+        renamed_a = Bunch(id=1, email='new@example.com')
+        self.scheduler.sync([renamed_a, c])
+        self.assertFalse(self.scheduler.is_scheduled(self.b))
+        due = self.pop_all()
+        self.assertEqual(set([1, 3]), set(u.id for u in due))
+        self.assertTrue(renamed_a in due)
+        self.assertEqual(None, self.scheduler.seconds_till_next_due())
+
+if __name__ == '__main__':
+    unittest.main()
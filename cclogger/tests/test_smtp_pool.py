@@ -0,0 +1,70 @@
+import smtplib
+import time
+import unittest
+
+from ..common_util import Bunch
+from ..smtp_pool import SmtpConnectionPool
+
+CONFIG = Bunch(hostname='localhost', port=25, use_ssl=False)
+
+class StubSmtp(object):
+    def __init__(self, error=None):
+        self.error = error
+        self.sent = list()
+        self.quit_called = False
+
+    def sendmail(self, from_email, to, msg):
+        if self.error:
+            raise self.error
+        self.sent.append((from_email, to, msg))
+
+    def quit(self):
+        self.quit_called = True
+
+class StubPool(SmtpConnectionPool):
+    "Hands out the given new sessions instead of connecting."
+    def __init__(self, new_sessions):
+        super(StubPool, self).__init__()
+        self.new_sessions = list(new_sessions)
+
+    def _connect(self, out_mail_config, username, password):
+        return self.new_sessions.pop(0)
+
+def reusing(pool, s):
+    pool.idle[(CONFIG.hostname, CONFIG.port, 'user')] = [(s, time.time())]
+    return pool
+
+class SendmailTest(unittest.TestCase):
+
+    def send(self, pool):
+        pool.sendmail(CONFIG, 'user', 'secret', 'a@x.com', ['b@x.com'], 'msg')
+
+    def test_reuses_idle_session(self):
+        s = StubSmtp()
+        pool = reusing(StubPool([]), s)
+        self.send(pool)
+        self.assertEqual(1, len(s.sent))
+        self.assertEqual(1, pool.get_stats()['idle'])
+
+    def test_reconnects_when_reused_session_is_closed(self):
+        fresh = StubSmtp()
+        pool = reusing(StubPool([fresh]), StubSmtp(smtplib.SMTPServerDisconnected('gone')))
+        self.send(pool)
+        self.assertEqual(1, len(fresh.sent))
+
+    def test_other_errors_quit_reused_session(self):
+        s = StubSmtp(smtplib.SMTPRecipientsRefused({'b@x.com': (550, 'No such user')}))
+        pool = reusing(StubPool([]), s)
+        self.assertRaises(smtplib.SMTPRecipientsRefused, self.send, pool)
+        self.assertTrue(s.quit_called)
+        self.assertEqual(0, pool.get_stats()['idle'])
+
+    def test_errors_quit_new_session(self):
+        s = StubSmtp(smtplib.SMTPDataError(554, 'Rejected'))
+        pool = StubPool([s])
+        self.assertRaises(smtplib.SMTPDataError, self.send, pool)
+        self.assertTrue(s.quit_called)
+        self.assertEqual(0, pool.get_stats()['idle'])
+
+if __name__ == '__main__':
+    unittest.main()
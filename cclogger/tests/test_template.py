@@ -0,0 +1,68 @@
+import unittest
+
+from ..html_text import html_to_text
+from ..parse import ParseCentral, SmsParseCentral
+from ..parsers.template import find_anchor
+
+def find_fields(parser, text):
+    rule = [rule for rule in parser.rules if rule.name == 'transaction'][0]
+    return rule.find_fields(parser, text)
+
+class FindAnchorTest(unittest.TestCase):
+
+    def test_longest_literal_run(self):
+        self.assertEqual(' was spent on your credit card',
+            find_anchor(r'(?P<amt>[0-9,.]+) was spent on your Credit Card\s+(?P<cc>[0-9X]+)'))
+
+    def test_runs_are_broken_by_classes_and_groups(self):
+        self.assertEqual('thank you for using', find_anchor(r'Thank you for using\s+your (?P<x>card)'))
+
+    def test_short_or_no_runs(self):
+        self.assertEqual(None, find_anchor(r'Rs\.?\s*(?P<amt>\d+)'))
+        self.assertEqual(None, find_anchor(r'(?P<a>.*)'))
+
+    def test_alternations_are_not_anchors(self):
+        self.assertEqual(None, find_anchor(r'(debited|credited)'))
+
+class SmsCandidateRulesTest(unittest.TestCase):
+
+    def test_only_rules_whose_anchors_are_found_are_tried(self):
+        central = SmsParseCentral.getInstance()
+        parser = central.get_parsers()['lm-citibk']
+        found = central.anchor_index.find('Rs 500.00 was spent on your Credit Card 4111XXXXXXXX1234 on 05-MAR-14 at BIG BAZAAR.')
+        self.assertEqual(set(['transaction']), central.get_candidate_rules(parser, found))
+        self.assertEqual(set(), central.get_candidate_rules(parser, central.anchor_index.find('Your statement is ready')))
+
+class BankTemplateTest(unittest.TestCase):
+
+    def test_citi_mail_place_ends_at_its_sentence(self):
+        parser = ParseCentral.getInstance().get_parsers()['citialert.india@citicorp.com']
+        text = html_to_text('<p>INR 1,250.00 was spent on your Credit Card 4111XXXXXXXX1234 on 05-MAR-14 at '
+            'AMAZON SELLER SERVICES. <b>Reference No:</b> AB12-34. Thank you for banking with us.</p>')
+
+        fields = find_fields(parser, text)
+        self.assertEqual('AMAZON SELLER SERVICES', fields['place'])
+        self.assertEqual('AB12-34', fields['meta1'])
+        self.assertEqual('05-MAR-14', fields['date'])
+
+    def test_citi_mail_place_may_contain_dots(self):
+        parser = ParseCentral.getInstance().get_parsers()['citialert.india@citicorp.com']
+        text = html_to_text('<td>INR 99.00 was spent on your Credit Card 4111XXXXXXXX1234 on 05-MAR-14 at '
+            'WWW.FLIPKART.COM.</td><td>Reference No: LT0001</td>')
+        self.assertEqual('WWW.FLIPKART.COM', find_fields(parser, text)['place'])
+
+    def test_citi_sms_place_ends_at_its_sentence(self):
+        parser = SmsParseCentral.getInstance().get_parsers()['lm-citibk']
+        fields = find_fields(parser, 'Rs 500.00 was spent on your Credit Card 4111XXXXXXXX1234 on 05-MAR-14 at '
+            'CAFE COFFEE DAY. Avl lmt Rs 12,000.00. Call 1800 for queries.')
+        self.assertEqual('CAFE COFFEE DAY', fields['place'])
+
+    def test_hdfc_sms_place_ends_at_its_sentence(self):
+        parser = SmsParseCentral.getInstance().get_parsers()['am-hdfcbk']
+        fields = find_fields(parser, 'Thank you for using your HDFC bank CREDIT card ending 1234 for Rs 350.00 in '
+            'MUMBAI. at BIG BAZAAR. , on 2014-03-05. Previous txn in MUMBAI. at DMART. , on 2014-03-01.')
+        self.assertEqual('BIG BAZAAR', fields['place'])
+        self.assertEqual('2014-03-05', fields['date'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,45 @@
+import threading
+import time
+import unittest
+
+from .sqlite_db import use_sqlite
+from .. import model
+from ..worker_pool import WorkerPool
+
+def square(item):
+    if item == 2:
+        raise ValueError('Bad item')
+    return item * item
+
+def fail_on_db(item):
+    model.db.get_conn()
+    raise ValueError('DB connection lost')
+
+class WorkerPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cleanup = use_sqlite()
+
+    def tearDown(self):
+        self.cleanup()
+
+    def test_map_keeps_order_and_failed_tasks_give_none(self):
+        pool = WorkerPool(3)
+        self.assertEqual([1, None, 9], pool.map(square, [1, 2, 3]))
+
+    def test_map_does_not_wait_for_other_tasks(self):
+        pool = WorkerPool(2)
+        release = threading.Event()
+        pool.submit(release.wait, 5) # Like an IDLE push still being processed.
+        start = time.time()
+        self.assertEqual([9], pool.map(square, [3]))
+        self.assertLess(time.time() - start, 1)
+        release.set()
+
+    def test_failed_task_closes_the_db_connection(self):
+        pool = WorkerPool(1)
+        pool.map(fail_on_db, [1])
+        self.assertEqual([True], pool.map(lambda item: model.db.is_closed(), [1]))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+import threading
+import traceback
+import Queue
+
+from .model import db
+from . import verbose
+
+class WorkerPool(object):
+    """Fixed size pool of daemon threads.
+
+    Each worker gets its own DB connection (the db is thread local). It is opened lazily on
+    the first query and kept for the life of the worker, so tasks do not pay the connection
+    cost every time. It is closed when a task fails, so that a connection the server dropped
+    is opened again by the next task instead of failing all of them.
+    """
+
+    def __init__(self, size, name='worker'):
+        self.size = max(1, size)
+        self.tasks = Queue.Queue()
+        self.workers = []
+        for i in range(self.size):
+            t = threading.Thread(target=self._work, name='%s-%d' % (name, i))
+            t.daemon = True
+            t.start()
+            self.workers.append(t)
+
+    def _work(self):
+        while True:
+            f, args, on_done = self.tasks.get()
+            try:
+                res = f(*args)
+                if on_done:
+                    on_done(res)
+            except Exception, e:
+                # Tasks are expected to handle their own errors. This only guards the worker.
+                print '>>> Uncaught exception in worker: ', str(e)
+                print traceback.format_exc()
+                if not db.is_closed():
+                    db.close() # Reconnects on next use.
+            finally:
+                self.tasks.task_done()
+
+    def submit(self, f, *args, **kwargs):
+        """Queues f(*args). on_done (if given) is called on the worker with the result."""
+        self.tasks.put((f, args, kwargs.get('on_done', None)))
+
+    def join(self):
+        """Blocks till all submitted tasks are done."""
+        self.tasks.join()
+
+    def map(self, f, items):
+        """Runs f on every item in parallel and blocks till all are done. Other tasks queued on the pool,
+        like IDLE pushes, are not waited for. Returns the results in the order of items. Result of a task
+        which raised is None."""
+        results = [None] * len(items)
+        remaining = [len(items)]
+        lock = threading.Lock()
+        all_done = threading.Event()
+        if not items:
+            all_done.set()
+
+        def run(i, item):
+            try:
+                results[i] = f(item)
+            finally:
+                with lock:
+                    remaining[0] -= 1
+                    if remaining[0] == 0:
+                        all_done.set()
+
+        for i, item in enumerate(items):
+            self.submit(run, i, item)
+        all_done.wait()
+
+        if verbose: print 'WorkerPool map completed for %d items.' % len(items)
+        return results